@@ -0,0 +1,91 @@
+"""Compare the columnar build_metadata_table with extract_metadata followed by
+transform_input_data, on synthetic signal headers.
+
+Run it from the root of the edge repository:
+
+    python -m mescobrad_edge.plugins.edf_anonymisation_plugin.benchmarks.\
+bench_metadata_table --channels 256 --repeat 20
+"""
+
+import argparse
+import datetime
+import json
+import random
+import timeit
+
+from mescobrad_edge.plugins.edf_anonymisation_plugin.entrypoint import \
+    GenericPlugin, METADATA_SIGNAL_FIELDS
+
+PREFILTERS = ["HP:0.1Hz LP:75Hz N:50Hz", "HP:0.5Hz LP:35Hz", "HP:DC",
+              "LP:100Hz N:60Hz", ""]
+
+
+def make_signal_headers(num_channels, seed=0):
+    """Signal headers shaped like the ones returned by parse_edf_header"""
+
+    rng = random.Random(seed)
+    return [{'label': f"EEG {i:03d}",
+             'dimension': "uV",
+             'sample_frequency': float(rng.choice([256, 512, 1024])),
+             'physical_max': 3276.7,
+             'physical_min': -3276.8,
+             'digital_max': 32767,
+             'digital_min': -32768,
+             'prefilter': rng.choice(PREFILTERS),
+             'transducer': "AgAgCl electrode"}
+            for i in range(num_channels)]
+
+
+def run_melt_path(plugin, signal_headers, args):
+    startdate_time, file_duration, personal_id, source_name, workspace_id, \
+        pseudoMRN, metadata_file_name = args
+    data = plugin.extract_metadata(signal_headers, METADATA_SIGNAL_FIELDS)
+    data.insert(0, 'file_duration', file_duration)
+    data.insert(0, 'startdate_time', startdate_time)
+    data.insert(0, "PID", personal_id)
+    return plugin.transform_input_data(data, source_name, workspace_id,
+                                       pseudoMRN, metadata_file_name)
+
+
+def run_columnar_path(plugin, signal_headers, args):
+    return plugin.build_metadata_table(signal_headers, METADATA_SIGNAL_FIELDS,
+                                       *args)
+
+
+def sorted_rows(data):
+    """Rows of the table, ignoring the order of the variables of a row"""
+
+    return sorted(map(tuple, data.astype(object).values.tolist()), key=str)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--channels", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=20)
+    options = parser.parse_args()
+
+    # The benchmark doesn't need the plugin virtualenv
+    plugin = GenericPlugin.__new__(GenericPlugin)
+
+    signal_headers = make_signal_headers(options.channels)
+    args = (datetime.datetime(2024, 1, 1, 8, 30), 86400.0, "0" * 64,
+            "recording.edf", "workspace", "1" * 64, "recording.json")
+
+    same_rows = sorted_rows(run_melt_path(plugin, signal_headers, args)) == \
+        sorted_rows(run_columnar_path(plugin, signal_headers, args))
+
+    results = {"channels": options.channels, "repeat": options.repeat,
+               "same_rows": same_rows}
+    for name, function in [("melt", run_melt_path),
+                           ("columnar", run_columnar_path)]:
+        seconds = min(timeit.repeat(
+            lambda: function(plugin, signal_headers, args),
+            number=1, repeat=options.repeat))
+        results[f"{name}_seconds"] = seconds
+    results["speedup"] = results["melt_seconds"] / results["columnar_seconds"]
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""Benchmark suite of the EDF anonymisation pipeline on synthetic recordings.
+
+For every combination of channels, sample rate, duration, annotation density
+and file type a recording is generated, then the anonymisation, metadata
+extraction, Trino insert, the full action and the header-only metadata
+extraction from the object storage are timed. The action runs
+offline against a moto S3 mock and a fake Trino connection. Results are
+written as JSON, so runs can be compared.
+
+Run it from the root of the edge repository, moto is required:
+
+    python -m mescobrad_edge.plugins.edf_anonymisation_plugin.benchmarks.\
+bench_pipeline --channels 32 256 --duration 600 --output results.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+from mescobrad_edge.plugins.edf_anonymisation_plugin.benchmarks.\
+    bench_metadata_table import run_melt_path
+from mescobrad_edge.plugins.edf_anonymisation_plugin.benchmarks.fakes import \
+    FakeTrinoConnection, LOCAL_BUCKET, REMOTE_BUCKET, make_offline_plugin
+from mescobrad_edge.plugins.edf_anonymisation_plugin.benchmarks.\
+    synthetic_edf import PATIENT_CODE, write_synthetic_edf
+from mescobrad_edge.plugins.edf_anonymisation_plugin.entrypoint import \
+    METADATA_SIGNAL_FIELDS, PipelineMetrics
+from mescobrad_edge.plugins.edf_anonymisation_plugin.models.plugin import \
+    PluginExchangeMetadata
+
+REMOVE_VALUES = ["patientname", "birthdate", "patient_additional",
+                 "patientcode", "admincode", "gender", "sex", "technician"]
+NEW_VALUES = [""] * len(REMOVE_VALUES)
+
+
+def measure(function, setup=None, repeat=3):
+    """Best wall time over repeat runs, then the peak traced memory of one
+    more run, as tracing slows the code down"""
+
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"seconds": best, "peak_traced_bytes": peak}
+
+
+def benchmark_file(plugin, path, workdir, repeat):
+    """Benchmarks of the stages working on a local file"""
+
+    anonymized = os.path.join(workdir, "anonymized.edf")
+    results = {}
+
+    results["anonymize_edf_header"] = measure(
+        lambda: plugin.anonymize_edf_header(path, anonymized, REMOVE_VALUES,
+                                            NEW_VALUES), repeat=repeat)
+    scrubber = plugin.get_annotation_scrubber(
+        {"name": "John", "surname": "Doe", "MRN": PATIENT_CODE})
+    results["anonymize_edf_header+scrub_annotations"] = measure(
+        lambda: plugin.anonymize_edf_header(path, anonymized, REMOVE_VALUES,
+                                            NEW_VALUES, scrubber),
+        repeat=repeat)
+    compressed = os.path.join(workdir, "anonymized.edf.zst")
+    try:
+        results["compress_edf_file"] = measure(
+            lambda: plugin.compress_edf_file(path, compressed), repeat=repeat)
+        results["compress_edf_file"]["compression_ratio"] = \
+            os.path.getsize(path) / os.path.getsize(compressed)
+    except ImportError:
+        # zstandard is optional
+        pass
+    results["read_edf_header_mmap"] = measure(
+        lambda: plugin.read_edf_header_mmap(path), repeat=repeat)
+
+    edf_info = plugin.read_edf_header_mmap(path)
+    args = (edf_info["startdate"], edf_info["Duration"], None,
+            os.path.basename(path), "workspace", None, None)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results["extract_metadata+transform_input_data"] = measure(
+            lambda: run_melt_path(plugin, edf_info["SignalHeaders"], args),
+            repeat=repeat)
+        results["build_metadata_table"] = measure(
+            lambda: plugin.build_metadata_table(edf_info["SignalHeaders"],
+                                                METADATA_SIGNAL_FIELDS, *args),
+            repeat=repeat)
+
+        data = plugin.build_metadata_table(edf_info["SignalHeaders"],
+                                           METADATA_SIGNAL_FIELDS, *args)
+        results["upload_data_on_trino"] = measure(
+            lambda: plugin.upload_data_on_trino(
+                "schema", "table", data, FakeTrinoConnection()),
+            repeat=repeat)
+        results["upload_data_on_trino"]["rows"] = len(data)
+
+    return results
+
+
+def benchmark_action(path, repeat, config):
+    """Full action, offline, from the upload of the recording to
+    edf_data_tmp/ until the cleanup"""
+
+    import boto3
+    from moto import mock_aws
+
+    from mescobrad_edge.plugins.edf_anonymisation_plugin import entrypoint
+
+    results = {}
+    with mock_aws():
+        entrypoint._S3_CLIENTS.clear()
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=LOCAL_BUCKET)
+        s3.create_bucket(Bucket=REMOTE_BUCKET)
+
+        connection = FakeTrinoConnection()
+        plugin = make_offline_plugin(connection, **config)
+        key = f"edf_data_tmp/{os.path.basename(path)}"
+        data_info = {"filename": key, "MRN": "123456",
+                     "workspace_id": "workspace", "name": "John",
+                     "surname": "Doe", "date_of_birth": "01-01-1980",
+                     "unique_id": "A123", "metadata_json_file": b"{}"}
+        metrics = []
+
+        def setup():
+            s3.upload_file(path, LOCAL_BUCKET, key)
+
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                response = plugin.action(
+                    PluginExchangeMetadata(data_info=dict(data_info)))
+            # The action doesn't raise, a failed run must not be timed
+            report = response.data_info["metrics"]
+            failed = [stage["stage"] for stage in report["stages"]
+                      if stage["status"] not in ("success", "skipped")]
+            if failed or "EDF processing failed" in output.getvalue():
+                raise RuntimeError(f"Stages {failed} of the action failed:\n"
+                                   f"{output.getvalue()}")
+            metrics.append(report)
+
+        results["action"] = measure(run, setup=setup, repeat=repeat)
+        results["action"]["rows"] = connection.rows_inserted // (repeat + 1)
+        # Stages of the fastest run
+        results["action"]["stages"] = min(
+            metrics, key=lambda report: report["total_seconds"])["stages"]
+
+        # Metadata of the recording from its headers only, with ranged GETs
+        archived = f"EEGs/edf/{os.path.basename(path)}"
+        s3.upload_file(path, LOCAL_BUCKET, archived)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results["extract_metadata_from_object"] = measure(
+                lambda: plugin.extract_metadata_from_object(
+                    archived, METADATA_SIGNAL_FIELDS, local=True),
+                repeat=repeat)
+        entrypoint._S3_CLIENTS.clear()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--channels", type=int, nargs="+", default=[32])
+    parser.add_argument("--sample-rate", type=int, nargs="+", default=[256])
+    parser.add_argument("--duration", type=int, nargs="+", default=[600],
+                        help="Duration of the recordings in seconds")
+    parser.add_argument("--annotations-per-minute", type=float, nargs="+",
+                        default=[0, 10])
+    parser.add_argument("--file-type", choices=["edf", "edfplus"], nargs="+",
+                        default=["edfplus"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--diskless", action="store_true",
+                        help="Also run the action in diskless mode")
+    parser.add_argument("--output", help="JSON file, printed if not set")
+    options = parser.parse_args()
+
+    # Fake credentials, so boto3 never looks for real ones
+    for variable in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+        os.environ.setdefault(variable, "benchmark")
+
+    import numpy
+    import pandas
+
+    report = {"created_on": datetime.datetime.now().isoformat(),
+              "environment": {"python": platform.python_version(),
+                              "platform": platform.platform(),
+                              "numpy": numpy.__version__,
+                              "pandas": pandas.__version__},
+              "results": []}
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # The plugin stages files relatively to the working directory
+        os.chdir(workdir)
+        try:
+            for channels, sample_rate, duration, density, file_type in \
+                    itertools.product(options.channels, options.sample_rate,
+                                      options.duration,
+                                      options.annotations_per_minute,
+                                      options.file_type):
+                if file_type == "edf" and density > 0:
+                    continue
+
+                scenario = {"channels": channels, "sample_rate": sample_rate,
+                            "duration": duration,
+                            "annotations_per_minute": density,
+                            "file_type": file_type}
+                path = os.path.join(workdir, "recording.edf")
+                size = write_synthetic_edf(
+                    path, channels=channels, sample_rate=sample_rate,
+                    duration=duration, annotations_per_minute=density,
+                    edfplus=file_type == "edfplus")
+
+                plugin = make_offline_plugin(FakeTrinoConnection())
+                results = benchmark_file(plugin, path, workdir,
+                                         options.repeat)
+                results.update(benchmark_action(path, options.repeat, {}))
+                if options.diskless:
+                    diskless = benchmark_action(
+                        path, options.repeat,
+                        {"DISKLESS_ANONYMIZATION": "true"})
+                    results["action_diskless"] = diskless["action"]
+
+                for name, result in results.items():
+                    result["mb_per_second"] = \
+                        size / (1024 * 1024) / result["seconds"] \
+                        if result["seconds"] > 0 else None
+                    report["results"].append({**scenario,
+                                              "file_bytes": size,
+                                              "benchmark": name, **result})
+                print(f"Benchmarked {scenario}", flush=True)
+        finally:
+            os.chdir(cwd)
+
+    report["peak_rss_bytes"] = PipelineMetrics.peak_rss_bytes()
+    content = json.dumps(report, indent=2, default=str)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            output_file.write(content)
+    else:
+        print(content)
+
+
+if __name__ == "__main__":
+    main()
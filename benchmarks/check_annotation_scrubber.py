@@ -0,0 +1,66 @@
+"""Behaviour checks of the annotation scrubber on hand written data records:
+identifiers are only replaced as whole words, so clinical annotation texts
+are left alone, and the onsets of the TALs are never modified.
+
+Run it from the root of the edge repository:
+
+    python -m mescobrad_edge.plugins.edf_anonymisation_plugin.benchmarks.\
+check_annotation_scrubber
+"""
+
+from mescobrad_edge.plugins.edf_anonymisation_plugin.entrypoint import \
+    AnnotationScrubber
+
+RECORD_BYTES = 128
+
+
+def make_record(*texts):
+    """One data record with a single annotation signal holding a time
+    keeping TAL followed by one TAL per text"""
+
+    tals = b"+0\x14\x14\x00" + b"".join(
+        f"+{onset}\x14{text}\x14\x00".encode("utf-8")
+        for onset, text in enumerate(texts, start=1))
+    if len(tals) > RECORD_BYTES:
+        raise ValueError("Annotations don't fit in the record.")
+    return bytearray(tals.ljust(RECORD_BYTES, b"\x00"))
+
+
+def scrub(scrubber, record):
+    layout = {"labels": ["EDF Annotations"], "signal_offsets": [0],
+              "samples_per_record": [RECORD_BYTES // 2],
+              "bytes_per_sample": 2, "record_size": RECORD_BYTES}
+    scrubber(memoryview(record), layout, 0)
+    return bytes(record)
+
+
+def check(name, scrubber, texts, expected):
+    scrubbed = scrub(scrubber, make_record(*texts))
+    wanted = bytes(make_record(*expected))
+    if scrubbed != wanted:
+        raise AssertionError(f"{name}: {scrubbed!r} != {wanted!r}")
+    print(f"{name}: ok")
+
+
+def main():
+    # Short name inside longer words, even below the default minimum length
+    check("short name within words",
+          AnnotationScrubber(["Ed Lee"], min_length=2),
+          ["Eyes closed, sleep onset"], ["Eyes closed, sleep onset"])
+    # Words shorter than the default minimum length are not matched at all
+    check("minimum length", AnnotationScrubber(["Ed Lee"]),
+          ["Ed moved", "Lee moved"], ["Ed moved", "XXX moved"])
+    check("whole words", AnnotationScrubber(["John Doe"]),
+          ["Patient John Doe, eyes closed", "Doeblin electrode",
+           "(doe)", "john"],
+          ["Patient XXXX XXX, eyes closed", "Doeblin electrode",
+           "(XXX)", "XXXX"])
+    check("identifier at the boundaries of a text",
+          AnnotationScrubber(["MRN0001234"]),
+          ["MRN0001234", "MRN00012345"], ["XXXXXXXXXX", "MRN00012345"])
+    check("pattern", AnnotationScrubber(pattern=r"\d{4}-\d{2}-\d{2}"),
+          ["born 1980-01-01"], ["born XXXXXXXXXX"])
+
+
+if __name__ == "__main__":
+    main()
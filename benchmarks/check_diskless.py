@@ -0,0 +1,114 @@
+"""Check that the diskless anonymisation writes the same bytes as the local
+path, offline against a moto S3 mock.
+
+Synthetic recordings smaller and larger than a multipart part are
+anonymised by anonymize_object, with and without annotation scrubbing,
+with both object storages on the same endpoint, where parts are copied with
+UploadPartCopy, and on different credentials, where parts are streamed. The
+remote object must be byte for byte the output of anonymize_edf_header.
+
+Run it from the root of the edge repository, moto is required:
+
+    python -m mescobrad_edge.plugins.edf_anonymisation_plugin.benchmarks.\
+check_diskless
+"""
+
+import contextlib
+import io
+import itertools
+import os
+import tempfile
+
+from mescobrad_edge.plugins.edf_anonymisation_plugin.benchmarks.\
+    bench_pipeline import NEW_VALUES, REMOVE_VALUES
+from mescobrad_edge.plugins.edf_anonymisation_plugin.benchmarks.fakes import \
+    FakeTrinoConnection, LOCAL_BUCKET, REMOTE_BUCKET, make_offline_plugin
+from mescobrad_edge.plugins.edf_anonymisation_plugin.benchmarks.\
+    synthetic_edf import PATIENT_CODE, write_synthetic_edf
+
+# Channels and duration of recordings under and over the 5 MB minimum size
+# of a multipart part
+RECORDINGS = {"small": (32, 60), "large": (64, 300)}
+DATA_INFO = {"name": "John", "surname": "Doe", "MRN": PATIENT_CODE}
+
+
+def check(plugin, s3, path, workdir, scrub, expect_copies):
+    """Anonymise the recording with both paths and compare the outputs.
+    Returns the number of parts copied with UploadPartCopy."""
+
+    scrubber = plugin.get_annotation_scrubber(DATA_INFO) if scrub else None
+    expected = os.path.join(workdir, "expected.edf")
+    plugin.anonymize_edf_header(path, expected, REMOVE_VALUES, NEW_VALUES,
+                                scrubber)
+
+    key = f"edf_data_tmp/{os.path.basename(path)}"
+    destination = f"EEGs/edf/{os.path.basename(path)}"
+    s3.upload_file(path, LOCAL_BUCKET, key)
+
+    copies = []
+    client = plugin.get_s3_client(local=False)
+    handler = lambda **kwargs: copies.append(1)
+    client.meta.events.register("before-call.s3.UploadPartCopy", handler)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            plugin.anonymize_object(key, destination, REMOVE_VALUES,
+                                    NEW_VALUES, scrubber)
+    finally:
+        client.meta.events.unregister("before-call.s3.UploadPartCopy",
+                                      handler)
+
+    content = s3.get_object(Bucket=REMOTE_BUCKET,
+                            Key=destination)["Body"].read()
+    with open(expected, "rb") as expected_file:
+        if content != expected_file.read():
+            raise AssertionError(f"Diskless output of {path} differs from "
+                                 f"anonymize_edf_header.")
+    if scrub and PATIENT_CODE.encode() in content:
+        raise AssertionError(f"Annotations of {path} were not scrubbed.")
+    if expect_copies != bool(copies):
+        raise AssertionError(f"UploadPartCopy was {'not ' * expect_copies}"
+                             f"used for {path}.")
+    return len(copies)
+
+
+def main():
+    import boto3
+    from moto import mock_aws
+
+    from mescobrad_edge.plugins.edf_anonymisation_plugin import entrypoint
+
+    # Fake credentials, so boto3 never looks for real ones
+    for variable in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+        os.environ.setdefault(variable, "benchmark")
+
+    with tempfile.TemporaryDirectory() as workdir, mock_aws():
+        entrypoint._S3_CLIENTS.clear()
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=LOCAL_BUCKET)
+        s3.create_bucket(Bucket=REMOTE_BUCKET)
+
+        for (name, (channels, duration)), same_storage, scrub in \
+                itertools.product(RECORDINGS.items(), [True, False],
+                                  [False, True]):
+            path = os.path.join(workdir, f"{name}.edf")
+            size = write_synthetic_edf(path, channels=channels,
+                                       duration=duration,
+                                       annotations_per_minute=10)
+            config = {} if same_storage else \
+                {"OBJ_STORAGE_ACCESS_ID": "benchmark-remote"}
+            plugin = make_offline_plugin(FakeTrinoConnection(), **config)
+            # Parts after the first one are only copied when the recording
+            # doesn't fit in the first part and its records are not scrubbed
+            part_size = max(
+                plugin.get_transfer_config(local=False).multipart_chunksize,
+                5 * 1024 * 1024)
+            expect_copies = same_storage and not scrub and size > part_size
+            copies = check(plugin, s3, path, workdir, scrub, expect_copies)
+            print(f"{name} ({size} bytes), same storage: {same_storage}, "
+                  f"scrubbed: {scrub}, copied parts: {copies}: ok")
+
+        entrypoint._S3_CLIENTS.clear()
+
+
+if __name__ == "__main__":
+    main()
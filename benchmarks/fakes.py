@@ -0,0 +1,96 @@
+"""Local stand-ins for the services used by the plugin, so the whole action
+can run offline: a DB-API connection recording the statements sent to Trino,
+and the configuration of a plugin pointing to a moto S3 mock."""
+
+import configparser
+import os
+
+from mescobrad_edge.plugins.edf_anonymisation_plugin.entrypoint import \
+    GenericPlugin
+
+LOCAL_BUCKET = "edge-local"
+REMOTE_BUCKET = "edge-remote"
+
+PLUGIN_CONFIG = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "plugin.config")
+
+
+class FakeTrinoCursor():
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+
+    def execute(self, operation, params=None):
+        self.connection.statements.append((operation, params))
+        if operation.lstrip().upper().startswith("INSERT") and params:
+            # One "(?, ...)" placeholder group per inserted row
+            self.rowcount = operation.count("(")
+            self.connection.rows_inserted += self.rowcount
+        return self
+
+    def executemany(self, operation, seq_of_params):
+        for params in seq_of_params:
+            self.execute(operation, params)
+        return self
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class FakeTrinoConnection():
+    """DB-API connection accepting every statement, counting inserted rows"""
+
+    def __init__(self):
+        self.statements = []
+        self.rows_inserted = 0
+        self.commits = 0
+
+    def cursor(self):
+        return FakeTrinoCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_offline_plugin(connection, **config):
+    """Plugin configured from plugin.config, with both object storages on the
+    default endpoint so they are served by moto, and Trino replaced by the
+    connection. The plugin virtualenv is not created, no processing ledger
+    is used and metadata rows are not buffered."""
+
+    plugin = GenericPlugin.__new__(GenericPlugin)
+
+    parser = configparser.ConfigParser()
+    parser.read(PLUGIN_CONFIG)
+    for key, value in parser["plugin-configuration"].items():
+        plugin.__dict__[f"__{key}__".upper()] = value
+
+    settings = {"OBJ_STORAGE_URL_LOCAL": None,
+                "OBJ_STORAGE_URL": None,
+                "OBJ_STORAGE_ACCESS_ID_LOCAL": "benchmark",
+                "OBJ_STORAGE_ACCESS_SECRET_LOCAL": "benchmark",
+                "OBJ_STORAGE_ACCESS_ID": "benchmark",
+                "OBJ_STORAGE_ACCESS_SECRET": "benchmark",
+                "OBJ_STORAGE_REGION": "us-east-1",
+                "OBJ_STORAGE_BUCKET_LOCAL": LOCAL_BUCKET,
+                "OBJ_STORAGE_BUCKET": REMOTE_BUCKET,
+                "OBJ_STORAGE_TABLE": "edf_metadata",
+                # Repeated runs on the same file must not be skipped, and
+                # rows are inserted file by file
+                "LEDGER_BACKEND": "",
+                "METADATA_SINK": "false"}
+    settings.update(config)
+    for key, value in settings.items():
+        plugin.__dict__[f"__{key.upper()}__"] = value
+
+    plugin.get_trino_connection = lambda: connection
+    return plugin
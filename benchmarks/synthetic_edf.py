@@ -0,0 +1,119 @@
+"""Generator of synthetic EDF and EDF+ recordings for the benchmarks.
+
+The files are written record by record with numpy, so recordings larger than
+the available memory can be generated, and they carry personal data in the
+header and in the annotations like real recordings do.
+"""
+
+import math
+
+import numpy as np
+
+PATIENT_NAME = "John_Doe"
+PATIENT_CODE = "MRN0001234"
+
+
+def _field(value, width):
+    value = str(value).encode("latin-1")
+    if len(value) > width:
+        raise ValueError(f"{value!r} does not fit in {width} characters.")
+    return value.ljust(width)
+
+
+def _annotation_onsets(duration, annotations_per_minute):
+    if annotations_per_minute <= 0:
+        return []
+    interval = 60.0 / annotations_per_minute
+    return [i * interval for i in range(int(duration / interval))]
+
+
+def _tal(onset, text=None):
+    if text is None:
+        # Time keeping annotation of the data record
+        return f"+{onset:g}\x14\x14\x00".encode("latin-1")
+    return f"+{onset:g}\x14{text}\x14\x00".encode("latin-1")
+
+
+def write_synthetic_edf(path, channels=32, sample_rate=256, duration=60,
+                        annotations_per_minute=0, edfplus=True,
+                        record_duration=1, batch_records=64, seed=0):
+    """Write a synthetic recording and return its size in bytes.
+
+    Each channel is random 16 bit noise. EDF+ files have an annotation signal
+    with one time keeping annotation per data record plus
+    annotations_per_minute free text annotations mentioning the patient. Plain
+    EDF files have no annotations.
+    """
+
+    rng = np.random.default_rng(seed)
+    num_records = int(math.ceil(duration / record_duration))
+    samples = int(sample_rate * record_duration)
+
+    # Annotations of each data record, sized for the fullest record
+    record_tals = [[_tal(record * record_duration)] if edfplus else []
+                   for record in range(num_records)]
+    onsets = _annotation_onsets(num_records * record_duration,
+                                annotations_per_minute) if edfplus else []
+    for onset in onsets:
+        record_tals[int(onset // record_duration)].append(
+            _tal(onset, f"Patient {PATIENT_NAME.replace('_', ' ')} "
+                        f"({PATIENT_CODE}) eyes closed"))
+    annotation_bytes = max((sum(len(tal) for tal in tals)
+                            for tals in record_tals), default=0)
+    annotation_samples = int(math.ceil(annotation_bytes / 2))
+
+    num_signals = channels + (1 if edfplus else 0)
+    labels = [f"EEG {i:03d}" for i in range(channels)]
+    samples_per_record = [samples] * channels
+    if edfplus:
+        labels.append("EDF Annotations")
+        samples_per_record.append(annotation_samples)
+
+    def signal_field(values, width):
+        return b"".join(_field(value, width) for value in values)
+
+    is_data = [True] * channels + [False] * (num_signals - channels)
+    header = b"".join([
+        _field("0", 8),
+        _field(f"{PATIENT_CODE} M 01-JAN-1980 {PATIENT_NAME} extra_info"
+               if edfplus else f"{PATIENT_NAME} {PATIENT_CODE}", 80),
+        _field("Startdate 01-JAN-2024 ADM01 Tech_One EEG-Amp"
+               if edfplus else "Recording of John Doe", 80),
+        _field("01.01.24", 8),
+        _field("08.30.00", 8),
+        _field(256 * (num_signals + 1), 8),
+        _field("EDF+C" if edfplus else "", 44),
+        _field(num_records, 8),
+        _field(record_duration, 8),
+        _field(num_signals, 4),
+        signal_field(labels, 16),
+        signal_field(["AgAgCl electrode" if data else ""
+                      for data in is_data], 80),
+        signal_field(["uV" if data else "" for data in is_data], 8),
+        signal_field(["-3276.8" if data else "-1" for data in is_data], 8),
+        signal_field(["3276.7" if data else "1" for data in is_data], 8),
+        signal_field(["-32768"] * num_signals, 8),
+        signal_field(["32767"] * num_signals, 8),
+        signal_field(["HP:0.1Hz LP:75Hz N:50Hz" if data else ""
+                      for data in is_data], 80),
+        signal_field(samples_per_record, 8),
+        signal_field([""] * num_signals, 32)])
+
+    record_size = 2 * sum(samples_per_record)
+    with open(path, "wb") as edf_file:
+        edf_file.write(header)
+        for first in range(0, num_records, batch_records):
+            count = min(batch_records, num_records - first)
+            records = np.zeros((count, record_size), dtype=np.uint8)
+            data = rng.integers(-32768, 32767,
+                                size=(count, channels * samples),
+                                dtype=np.int16)
+            records[:, :channels * samples * 2] = data.view(np.uint8)
+            for index in range(count):
+                tals = b"".join(record_tals[first + index])
+                start = channels * samples * 2
+                records[index, start:start + len(tals)] = \
+                    np.frombuffer(tals, dtype=np.uint8)
+            edf_file.write(records.tobytes())
+
+    return len(header) + num_records * record_size
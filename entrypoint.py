@@ -1,16 +1,1302 @@
 from mescobrad_edge.plugins.edf_anonymisation_plugin.models.plugin import \
     EmptyPlugin, PluginActionResponse, PluginExchangeMetadata
-import pyedflib
+import atexit
+import contextlib
+import threading
+
+# Size of the fixed-width EDF/BDF main header and the (offset, width) of the
+# main header fields which are read or rewritten without decoding the signals
+EDF_MAIN_HEADER_SIZE = 256
+EDF_PATIENT_FIELD = (8, 80)
+EDF_RECORDING_FIELD = (88, 80)
+EDF_HEADER_BYTES_FIELD = (184, 8)
+EDF_RESERVED_FIELD = (192, 44)
+EDF_STARTDATE_FIELD = (168, 8)
+EDF_STARTTIME_FIELD = (176, 8)
+EDF_NUM_RECORDS_FIELD = (236, 8)
+EDF_RECORD_DURATION_FIELD = (244, 8)
+EDF_NUM_SIGNALS_FIELD = (252, 4)
+
+# Size of each signal header field in the order they are stored after the main
+# header, every field is repeated for all the signals
+EDF_SIGNAL_HEADER_FIELDS = [("label", 16), ("transducer", 80),
+                            ("dimension", 8), ("physical_min", 8),
+                            ("physical_max", 8), ("digital_min", 8),
+                            ("digital_max", 8), ("prefilter", 80),
+                            ("samples_per_record", 8), ("reserved", 32)]
+EDF_SIGNAL_HEADER_SIZE = 256
+
+# Number of data records read, transformed and written at once when the data
+# records of an edf file are streamed
+DEFAULT_STREAM_BATCH_RECORDS = 64
+
+# Signal header fields inserted into Trino for each signal
+METADATA_SIGNAL_FIELDS = ['label', 'sample_rate', 'sample_frequency',
+                          'prefilter', 'dimension']
+
+# Objects picked up by the metadata sweeps of a prefix
+EDF_OBJECT_SUFFIXES = (".edf", ".bdf", ".edf.zst", ".bdf.zst")
+
+class S3ClientCache():
+    """Thread safe cache of S3 clients keyed by endpoint and credentials, so
+    sessions, credentials and connection pools are created once per process
+    and shared by all the helpers and threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def get_client(self, endpoint_url, access_id, access_secret, region,
+                   max_pool_connections=10, tcp_keepalive=True):
+        key = (endpoint_url, access_id, access_secret, region,
+               max_pool_connections, tcp_keepalive)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                import boto3
+                from botocore.client import Config
+
+                session = boto3.session.Session(
+                    aws_access_key_id=access_id,
+                    aws_secret_access_key=access_secret,
+                    region_name=region)
+                client = session.client(
+                    's3',
+                    endpoint_url=endpoint_url,
+                    config=Config(signature_version='s3v4',
+                                  max_pool_connections=max_pool_connections,
+                                  tcp_keepalive=tcp_keepalive))
+                self._clients[key] = client
+        return client
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+_S3_CLIENTS = S3ClientCache()
+
+class PipelineMetrics():
+    """Wall time, bytes processed and rows of each stage of the processing of
+    one file, with the high-water mark of the RSS of the process when the
+    stage ended. Stages are also passed to the registered tracers,
+    callables taking the stage name and returning a context manager."""
+
+    def __init__(self, filename, tracers=()):
+        self.filename = filename
+        self.tracers = list(tracers)
+        self.stages = []
+
+    @staticmethod
+    def peak_rss_bytes():
+        """High-water mark of the RSS of the process since it started, not
+        of a stage"""
+
+        import resource
+        import sys
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS and in kilobytes on Linux
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Record the stage run in the with block, which can set the "bytes"
+        and "rows" of the yielded record"""
+
+        import time
+
+        record = {"stage": name, "status": "success", "bytes": 0, "rows": 0}
+        with contextlib.ExitStack() as spans:
+            for tracer in self.tracers:
+                spans.enter_context(tracer(name))
+            started = time.perf_counter()
+            try:
+                yield record
+            except BaseException:
+                record["status"] = "failed"
+                raise
+            finally:
+                record["seconds"] = time.perf_counter() - started
+                record["process_max_rss_bytes"] = self.peak_rss_bytes()
+                self.stages.append(record)
+
+    def report(self):
+        return {"filename": self.filename,
+                "total_seconds": sum(stage["seconds"]
+                                     for stage in self.stages),
+                "stages": [dict(stage) for stage in self.stages]}
+
+    @staticmethod
+    def to_prometheus(metrics_list):
+        """Stage metrics of several files in the Prometheus text format,
+        aggregated by stage and status so the series don't depend on the
+        files of the batch. Metrics of each file are in the reports only."""
+
+        aggregates = {}
+        for metrics in metrics_list:
+            for stage in metrics.stages:
+                aggregate = aggregates.setdefault(
+                    (stage["stage"], stage["status"]),
+                    {"count": 0, "seconds": [], "bytes": [], "rows": []})
+                aggregate["count"] += 1
+                for sample in ("seconds", "bytes", "rows"):
+                    aggregate[sample].append(stage[sample])
+
+        lines = ["# HELP edf_anonymisation_stage_count Runs of the stage",
+                 "# TYPE edf_anonymisation_stage_count gauge"]
+        for (stage, status), aggregate in aggregates.items():
+            lines.append(f'edf_anonymisation_stage_count{{stage="{stage}",'
+                         f'status="{status}"}} {aggregate["count"]}')
+
+        samples = [("seconds", "wall time of the stage in seconds"),
+                   ("bytes", "bytes processed by the stage"),
+                   ("rows", "rows written by the stage")]
+        for sample, description in samples:
+            for name, function in (("sum", sum), ("max", max)):
+                metric = f"edf_anonymisation_stage_{sample}_{name}"
+                lines.append(f"# HELP {metric} {name.capitalize()} of the "
+                             f"{description}")
+                lines.append(f"# TYPE {metric} gauge")
+                for (stage, status), aggregate in aggregates.items():
+                    lines.append(f'{metric}{{stage="{stage}",'
+                                 f'status="{status}"}} '
+                                 f'{function(aggregate[sample])}')
+
+        metric = "edf_anonymisation_process_max_rss_bytes"
+        lines.append(f"# HELP {metric} High-water mark of the RSS of the "
+                     f"process")
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {PipelineMetrics.peak_rss_bytes()}")
+        return "\n".join(lines) + "\n"
+
+# Compactions of the filename to pid mapping read and rewrite the compacted
+# files, so they run one at a time within a process. Compactions of several
+# processes or nodes are arbitrated by the conditional update of the pointer.
+_PID_MAPPING_LOCK = threading.Lock()
+
+
+class FilenamePidMappingStore():
+    """Filename to pid mapping kept in the object storage as small append only
+    segments, which are periodically merged into a new generation of
+    compacted files. A generation has one CSV file of the rows sorted by each
+    of filename, personal_id and pseudoMRN, each with a sparse index of the
+    first value and offset of its blocks, so a lookup reads a few blocks. The
+    pointer object names the current generation and the segments it holds,
+    it is replaced with a conditional PUT, so a compaction losing the race to
+    another one changes nothing."""
+
+    COLUMNS = ['filename', 'personal_id', 'pseudoMRN', 'MRN']
+    INDEXED_COLUMNS = ['filename', 'personal_id', 'pseudoMRN']
+    # Size of the blocks of the sorted files indexed by the sparse indexes
+    BLOCK_BYTES = 64 * 1024
+
+    def __init__(self, s3_client, bucket, folder="file_pid/",
+                 compact_segments=100):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.folder = folder
+        self.compact_segments = compact_segments
+        # Single CSV file of the mapping written before generations existed
+        self.file_path = f"{folder}filename_pid.csv"
+        self.pointer_path = f"{folder}filename_pid.current.json"
+        self.generations_prefix = f"{folder}generations/"
+        self.segments_prefix = f"{folder}segments/"
+
+    def encode_rows(self, rows, header=True):
+        import csv
+        import io
+
+        data = io.StringIO()
+        writer = csv.writer(data)
+        if header:
+            writer.writerow(self.COLUMNS)
+        writer.writerows(rows)
+        return data.getvalue().encode('utf-8')
+
+    def decode_rows(self, content, header=True):
+        import csv
+        import io
+
+        rows = list(csv.reader(io.StringIO(content.decode('utf-8'))))
+        if header:
+            # Older files may have different column names, columns are always
+            # in the same order
+            rows = rows[1:]
+        return [(row + [''] * len(self.COLUMNS))[:len(self.COLUMNS)]
+                for row in rows if row]
+
+    def get_object(self, key, byte_range=None):
+        from botocore.exceptions import ClientError
+
+        kwargs = {"Range": byte_range} if byte_range is not None else {}
+        try:
+            return self.s3_client.get_object(Bucket=self.bucket, Key=key,
+                                             **kwargs)["Body"].read()
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def list_keys(self, prefix):
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        keys = []
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        return sorted(keys)
+
+    def list_segments(self):
+        return self.list_keys(self.segments_prefix)
+
+    def get_pointer(self):
+        """Current generation and its ETag, None when nothing is compacted"""
+
+        import json
+
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket,
+                                                 Key=self.pointer_path)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None, None
+            raise
+        return json.loads(response["Body"].read()), response["ETag"]
+
+    def pending_segments(self, pointer):
+        """Segments whose rows are not in the generation of the pointer"""
+
+        merged = set(pointer["segments"]) if pointer else set()
+        return [segment for segment in self.list_segments()
+                if segment not in merged]
+
+    def sorted_file_path(self, generation, column):
+        return f"{generation}by_{column}.csv"
+
+    def sparse_index_path(self, generation, column):
+        return f"{generation}by_{column}.index.csv"
+
+    def write_sorted_file(self, generation, column, rows):
+        """Write the rows sorted by the column, and the first value and
+        offset of each block of about BLOCK_BYTES, blocks end on a row"""
+
+        position = self.COLUMNS.index(column)
+        # Stable sort, so rows of the same value keep their order
+        rows = sorted(rows, key=lambda row: row[position])
+
+        content = [self.encode_rows([])]
+        offset = len(content[0])
+        blocks = []
+        block_start = None
+        for row in rows:
+            line = self.encode_rows([row], header=False)
+            if block_start is None or offset - block_start >= \
+                    self.BLOCK_BYTES:
+                block_start = offset
+                blocks.append([row[position], offset])
+            content.append(line)
+            offset += len(line)
+        # End of the last block
+        blocks.append(["", offset])
+
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self.sorted_file_path(generation, column),
+            Body=b"".join(content), ContentType="text/csv")
+        index = self.encode_rows(blocks, header=False)
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self.sparse_index_path(generation, column),
+            Body=index, ContentType="text/csv")
+
+    def read_generation(self, pointer):
+        """All the rows of the generation, sorted by filename"""
+
+        if pointer is None:
+            content = self.get_object(self.file_path)
+            return self.decode_rows(content) if content else []
+        content = self.get_object(self.sorted_file_path(
+            pointer["generation_path"], "filename"))
+        if content is None:
+            raise RuntimeError(f"Generation {pointer['generation']} of the "
+                               f"filename to pid mapping is missing.")
+        return self.decode_rows(content)
+
+    def append(self, rows):
+        """Write the rows as a new segment, existing objects are not read"""
+
+        import time
+        import uuid
+
+        key = f"{self.segments_prefix}{time.time_ns()}-{uuid.uuid4().hex}.csv"
+        self.s3_client.put_object(Bucket=self.bucket, Key=key,
+                                  Body=self.encode_rows(rows),
+                                  ContentType="text/csv")
+        return key
+
+    def compact(self, min_segments=0):
+        """Merge the pending segments and the current generation into a new
+        generation, and make it current with a conditional PUT of the
+        pointer. Only the compaction winning the PUT deletes the segments it
+        holds, a losing one deletes its own files. Nothing is done when fewer
+        than min_segments segments are pending. Returns the number of rows of
+        the new generation, or None when it was not made current."""
+
+        import json
+        import uuid
+
+        from botocore.exceptions import ClientError
+
+        with _PID_MAPPING_LOCK:
+            pointer, etag = self.get_pointer()
+            listed = self.list_segments()
+            merged = set(pointer["segments"]) if pointer else set()
+            pending = [segment for segment in listed
+                       if segment not in merged]
+            if not pending or len(pending) < min_segments:
+                return None
+
+            rows = self.read_generation(pointer)
+            for segment in pending:
+                rows.extend(self.decode_rows(self.get_object(segment) or b""))
+
+            number = pointer["generation"] + 1 if pointer else 1
+            generation = f"{self.generations_prefix}{number:012d}-" \
+                f"{uuid.uuid4().hex}/"
+            for column in self.INDEXED_COLUMNS:
+                self.write_sorted_file(generation, column, rows)
+
+            # Segments of the previous generation still listed were not
+            # deleted yet, they stay excluded from the next merge
+            segments = [segment for segment in listed if segment in merged] \
+                + pending
+            content = json.dumps({"generation": number,
+                                  "generation_path": generation,
+                                  "rows": len(rows),
+                                  "segments": segments}).encode('utf-8')
+            condition = {"IfMatch": etag} if etag is not None \
+                else {"IfNoneMatch": "*"}
+            try:
+                self.s3_client.put_object(
+                    Bucket=self.bucket, Key=self.pointer_path, Body=content,
+                    ContentType="application/json", **condition)
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in (
+                        "PreconditionFailed", "ConditionalRequestConflict",
+                        "NoSuchKey", "412", "409"):
+                    raise
+                # Another compaction made its generation current first
+                for key in self.list_keys(generation):
+                    self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+                return None
+
+            for segment in segments:
+                self.s3_client.delete_object(Bucket=self.bucket, Key=segment)
+            # The previous generation is kept for the lookups still reading
+            # it, older ones are deleted
+            for key in self.list_keys(self.generations_prefix):
+                if int(key[len(self.generations_prefix):].split("-", 1)[0]) \
+                        < number - 1:
+                    self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+
+        return len(rows)
+
+    def maybe_compact(self):
+        pointer, _ = self.get_pointer()
+        if len(self.pending_segments(pointer)) >= self.compact_segments:
+            # Checked again by the compaction, once it holds the lock
+            self.compact(min_segments=self.compact_segments)
+
+    def read_all(self):
+        """All the rows, as a DataFrame with the columns of the CSV file"""
+
+        import pandas as pd
+
+        pointer, _ = self.get_pointer()
+        rows = self.read_generation(pointer)
+        for segment in self.pending_segments(pointer):
+            rows.extend(self.decode_rows(self.get_object(segment) or b""))
+        return pd.DataFrame(rows, columns=self.COLUMNS)
+
+    def lookup(self, column, value):
+        """Rows with the given filename, personal_id or pseudoMRN. The sparse
+        index of the file sorted by the column gives the blocks which can hold
+        the value, they are fetched with one ranged GET, then the segments
+        which are not compacted yet are read in full."""
+
+        import bisect
+
+        if column not in self.INDEXED_COLUMNS:
+            raise ValueError(f"Lookup by {column} is not supported.")
+        position = self.COLUMNS.index(column)
+
+        pointer, _ = self.get_pointer()
+        rows = []
+        if pointer is not None:
+            generation = pointer["generation_path"]
+            blocks = self.decode_rows(self.get_object(
+                self.sparse_index_path(generation, column)) or b"",
+                header=False)
+            values = [block[0] for block in blocks[:-1]]
+            offsets = [int(block[1]) for block in blocks]
+            # Rows of the value start in the last block starting before it
+            # and end in the last block starting with it
+            first = max(bisect.bisect_left(values, value) - 1, 0)
+            end = bisect.bisect_right(values, value)
+            if end > first:
+                content = self.get_object(
+                    self.sorted_file_path(generation, column),
+                    f"bytes={offsets[first]}-{offsets[end] - 1}")
+                rows.extend(row for row in
+                            self.decode_rows(content or b"", header=False)
+                            if row[position] == value)
+        elif self.get_object(self.file_path) is not None:
+            # Mapping file written before generations existed
+            rows.extend(row for row in
+                        self.decode_rows(self.get_object(self.file_path))
+                        if row[position] == value)
+
+        for segment in self.pending_segments(pointer):
+            rows.extend(row for row in
+                        self.decode_rows(self.get_object(segment) or b"")
+                        if row[position] == value)
+
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+# Stages of the processing of a file with effects outside of the node, which
+# are recorded in the processing ledger so that reruns don't repeat them
+LEDGER_STAGES = ("trino_insert", "pid_mapping", "upload")
+
+# Entries of the S3 ledger are read and rewritten, so updates run one at a
+# time within a process
+_LEDGER_LOCK = threading.Lock()
+
+
+class SQLiteProcessingLedger():
+    """Status of the stages of each processed file, in a local SQLite
+    database. A connection is opened for each call, so the ledger can be used
+    from several threads and processes of the node."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        import os
+        import sqlite3
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS ledger ("
+                     "key TEXT NOT NULL, stage TEXT NOT NULL, "
+                     "status TEXT NOT NULL, filename TEXT, updated REAL, "
+                     "PRIMARY KEY (key, stage))")
+        return conn
+
+    def get(self, key):
+        """Status of each recorded stage of the file"""
+
+        with contextlib.closing(self.connect()) as conn:
+            rows = conn.execute("SELECT stage, status FROM ledger "
+                                "WHERE key = ?", (key,)).fetchall()
+        return dict(rows)
+
+    def mark(self, key, stage, status, filename=None):
+        import time
+
+        with contextlib.closing(self.connect()) as conn:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO ledger "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             (key, stage, status, filename, time.time()))
+
+
+class S3ProcessingLedger():
+    """Status of the stages of each processed file, as one JSON object per
+    file in the object storage, so the ledger can be shared by several
+    nodes. The same file must not be processed by two nodes at once."""
+
+    def __init__(self, s3_client, bucket, folder="ledger/"):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.folder = folder
+
+    def read_entry(self, key):
+        import json
+        from botocore.exceptions import ClientError
+
+        try:
+            content = self.s3_client.get_object(
+                Bucket=self.bucket, Key=f"{self.folder}{key}.json")["Body"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return {"stages": {}}
+            raise
+        return json.loads(content.read())
+
+    def get(self, key):
+        """Status of each recorded stage of the file"""
+
+        return self.read_entry(key)["stages"]
+
+    def mark(self, key, stage, status, filename=None):
+        import json
+        import time
+
+        with _LEDGER_LOCK:
+            entry = self.read_entry(key)
+            entry["stages"][stage] = status
+            entry["filename"] = filename
+            entry["updated"] = time.time()
+            self.s3_client.put_object(Bucket=self.bucket,
+                                      Key=f"{self.folder}{key}.json",
+                                      Body=json.dumps(entry).encode('utf-8'),
+                                      ContentType="application/json")
+
+# Position of the pyedflib header keys within the space separated subfields of
+# the EDF+ local patient and local recording identification fields
+EDFPLUS_PATIENT_SUBFIELDS = {"patientcode": 0, "sex": 1, "gender": 1,
+                             "birthdate": 2, "patientname": 3,
+                             "patient_additional": 4}
+EDFPLUS_RECORDING_SUBFIELDS = {"admincode": 2, "technician": 3,
+                               "equipment": 4, "recording_additional": 5}
+
+# Metadata sinks of the process by spool prefix, shared by the plugin instances
+# and closed, i.e. flushed, when the process exits
+_METADATA_SINKS = {}
+_METADATA_SINKS_LOCK = threading.Lock()
+
+
+class TrinoMetadataSink():
+    """Write-behind buffer of the metadata rows of several files, inserted
+    into a Trino table with a long lived connection when max_rows rows are
+    buffered or the oldest row has waited max_seconds. Each flush is a
+    single INSERT when chunk_rows is large enough, and a single commit.
+
+    Rows are appended to a local JSON lines spool, and synced, before being
+    accepted. Each sink has its own spool, named after spool_prefix, the pid
+    and a random suffix, and holds an exclusive flock on its .lock file while
+    it lives. The spool is renamed to a .flushing file during a flush and
+    removed once the rows are committed. Spools of dead processes, whose
+    lock can be taken, are taken over at the next start and their rows are
+    inserted again, after deleting the rows of the same source files in case
+    a flush was interrupted, so no row is lost or duplicated."""
+
+    def __init__(self, plugin, schema_name, table_name, spool_prefix,
+                 max_rows=5000, max_seconds=60.0, chunk_rows=5000,
+                 transaction=False):
+        import os
+        import uuid
+
+        self.plugin = plugin
+        self.schema_name = schema_name
+        self.table_name = table_name
+        self.spool_prefix = spool_prefix
+        self.spool_path = \
+            f"{spool_prefix}.{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl"
+        self.flushing_path = f"{self.spool_path}.flushing"
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.chunk_rows = chunk_rows
+        self.transaction = transaction
+
+        self.conn = None
+        self.entries = []
+        self.oldest = None
+        self.lock = threading.RLock()
+        self.closed = threading.Event()
+
+        directory = os.path.dirname(spool_prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The spool is locked before it is written, so it is never taken over
+        # while the process lives
+        self.lock_file = self.lock_spool(self.spool_path)
+        self.recover()
+
+        if max_seconds > 0:
+            self.flusher = threading.Thread(target=self.flush_periodically,
+                                            daemon=True)
+            self.flusher.start()
+
+    @property
+    def buffered_rows(self):
+        return sum(len(entry["rows"]) for entry in self.entries)
+
+    def read_spool(self, path):
+        import json
+        import os
+
+        if not os.path.exists(path):
+            return []
+        with open(path, "r", encoding="utf-8") as spool:
+            # A line cut by a crash was never accepted
+            entries = []
+            for line in spool:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+        return entries
+
+    def write_spool(self, entries):
+        """Replace the spool with the entries, atomically"""
+
+        import json
+        import os
+
+        with open(f"{self.spool_path}.tmp", "w", encoding="utf-8") as spool:
+            for entry in entries:
+                spool.write(json.dumps(entry) + "\n")
+            spool.flush()
+            os.fsync(spool.fileno())
+        os.replace(f"{self.spool_path}.tmp", self.spool_path)
+
+    @staticmethod
+    def lock_spool(spool_path):
+        """Open the lock file of the spool and take its exclusive flock.
+        Returns the open file, or None when another process holds it. Without
+        fcntl the spool is locked when the process of its name is dead."""
+
+        import os
+
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+
+        if fcntl is None:
+            owner = os.path.basename(spool_path).rsplit(".", 2)[-2]
+            pid = owner.split("-", 1)[0]
+            if pid.isdigit() and int(pid) != os.getpid() and \
+                    AdmissionController.is_alive(int(pid)):
+                return None
+            return open(f"{spool_path}.lock", "a")
+
+        lock_file = open(f"{spool_path}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def recover(self):
+        """Take over the spools of dead processes, whose lock can be taken,
+        and load their rows. Rows of an interrupted flush may have been
+        committed, so their source files are replaced when they are inserted
+        again. The rows are synced to the spool of the sink before the
+        spools taken over are removed."""
+
+        import glob
+        import os
+        import time
+
+        prefix = glob.escape(self.spool_prefix)
+        # Spools of dead sinks may only have their lock or .flushing file
+        # left, the spool shared by the processes of older versions is taken
+        # over too
+        spools = {path.rsplit(".jsonl", 1)[0] + ".jsonl"
+                  for pattern in (f"{prefix}.jsonl*", f"{prefix}.*.jsonl",
+                                  f"{prefix}.*.jsonl.flushing",
+                                  f"{prefix}.*.jsonl.lock")
+                  for path in glob.glob(pattern)}
+        spools.discard(self.spool_path)
+
+        for spool_path in sorted(spools):
+            lock_file = self.lock_spool(spool_path)
+            if lock_file is None:
+                # Spool of a live sink
+                continue
+            try:
+                interrupted = self.read_spool(f"{spool_path}.flushing")
+                for entry in interrupted:
+                    entry["replace"] = True
+                entries = interrupted + self.read_spool(spool_path)
+                if entries:
+                    self.entries.extend(entries)
+                    self.write_spool(self.entries)
+                    rows = sum(len(entry["rows"]) for entry in entries)
+                    print(f"Recovered {rows} metadata rows from "
+                          f"{spool_path}")
+                for path in (f"{spool_path}.flushing", spool_path,
+                             f"{spool_path}.tmp", f"{spool_path}.lock"):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+            finally:
+                lock_file.close()
+
+        if self.entries:
+            self.oldest = time.monotonic()
+
+    def add(self, data, replace=False):
+        """Buffer the rows of a table returned by build_metadata_table, once
+        they are synced to the spool. With replace, the rows already in the
+        table for the same source file are deleted before the insert. Returns
+        the number of rows."""
+
+        import json
+        import os
+        import time
+
+        entry = {"columns": [str(column) for column in data.columns],
+                 "rows": data.astype(object).values.tolist(),
+                 "replace": replace}
+        line = json.dumps(entry, default=str) + "\n"
+
+        with self.lock:
+            with open(self.spool_path, "a", encoding="utf-8") as spool:
+                spool.write(line)
+                spool.flush()
+                os.fsync(spool.fileno())
+            self.entries.append(entry)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+
+            if self.buffered_rows >= self.max_rows:
+                try:
+                    self.flush()
+                except Exception as e:
+                    # The rows are spooled, they are sent by the next flush
+                    print(f"Flush of the metadata rows failed with "
+                          f"error: {e}")
+
+        return len(entry["rows"])
+
+    def get_connection(self):
+        if self.conn is None:
+            self.conn = self.plugin.get_trino_connection(
+                transactional=True) if self.transaction else \
+                self.plugin.get_trino_connection()
+        return self.conn
+
+    def flush(self):
+        """Insert the buffered rows and commit them. On failure the rows stay
+        buffered, the connection is dropped and the error is raised."""
+
+        import os
+        import pandas as pd
+
+        with self.lock:
+            if not self.entries:
+                return 0
+
+            entries = self.entries
+            if os.path.exists(self.spool_path):
+                os.replace(self.spool_path, self.flushing_path)
+
+            try:
+                conn = self.get_connection()
+                columns = entries[0]["columns"]
+                for entry in entries:
+                    if entry["replace"]:
+                        row = dict(zip(entry["columns"], entry["rows"][0])) \
+                            if entry["rows"] else {}
+                        self.plugin.delete_data_on_trino(
+                            self.schema_name, self.table_name,
+                            row.get("source"), row.get("workspace_id"), conn)
+
+                data = pd.DataFrame([row for entry in entries
+                                     for row in entry["rows"]],
+                                    columns=columns)
+                self.plugin.upload_data_on_trino(
+                    self.schema_name, self.table_name, data, conn,
+                    chunk_rows=self.chunk_rows)
+                conn.commit()
+            except Exception:
+                # Some chunks may be committed already, so the rows of these
+                # files are replaced by the next flush
+                for entry in entries:
+                    entry["replace"] = True
+                self.write_spool(entries)
+                if os.path.exists(self.flushing_path):
+                    os.remove(self.flushing_path)
+                if self.conn is not None:
+                    with contextlib.suppress(Exception):
+                        self.conn.close()
+                    self.conn = None
+                raise
+
+            if os.path.exists(self.flushing_path):
+                os.remove(self.flushing_path)
+            self.entries = []
+            self.oldest = None
+            return len(data)
+
+    def flush_periodically(self):
+        import time
+
+        while not self.closed.wait(min(self.max_seconds, 1.0)):
+            with self.lock:
+                due = self.oldest is not None and \
+                    time.monotonic() - self.oldest >= self.max_seconds
+                if due:
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        print(f"Flush of the metadata rows failed with "
+                              f"error: {e}")
+
+    def close(self):
+        """Flush the rows and release the spool. The spool of a failed flush
+        is left for the next start to take over."""
+
+        import os
+
+        self.closed.set()
+        try:
+            self.flush()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.spool_path)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(f"{self.spool_path}.lock")
+        finally:
+            if self.conn is not None:
+                with contextlib.suppress(Exception):
+                    self.conn.close()
+                self.conn = None
+            self.lock_file.close()
+
+
+def close_metadata_sinks():
+    """Flush the buffered metadata rows of every sink of the process"""
+
+    with _METADATA_SINKS_LOCK:
+        sinks = list(_METADATA_SINKS.values())
+        _METADATA_SINKS.clear()
+    for sink in sinks:
+        try:
+            sink.close()
+        except Exception as e:
+            # The rows stay in the spool for the next start
+            print(f"Flush of the metadata rows failed with error: {e}")
+
+
+atexit.register(close_metadata_sinks)
+
+
+# Admission controllers of the process by spool directory
+_ADMISSION_CONTROLLERS = {}
+_ADMISSION_CONTROLLERS_LOCK = threading.Lock()
+
+
+class AdmissionController():
+    """Admit jobs while the disk and memory they are estimated to use fit in
+    the budgets. Reservations are kept in a file of the spool directory,
+    locked while it is updated, so that every invocation on the node using
+    the same spool directory shares the budgets. Reservations of processes
+    which are gone are dropped. A job larger than a budget is admitted alone,
+    so it never waits forever."""
+
+    def __init__(self, spool_dir, disk_budget=None, memory_budget=None,
+                 poll_seconds=0.5):
+        import os
+
+        self.spool_dir = spool_dir
+        self.disk_budget = disk_budget
+        self.memory_budget = memory_budget
+        self.poll_seconds = poll_seconds
+        self.reservations_path = os.path.join(spool_dir, ".admission.json")
+        self.lock_path = os.path.join(spool_dir, ".admission.lock")
+
+        self.condition = threading.Condition()
+        self.queued = 0
+        self.stats = {"admitted": 0, "max_queue_depth": 0,
+                      "total_wait_seconds": 0.0, "max_wait_seconds": 0.0}
+        os.makedirs(spool_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def locked_reservations(self):
+        """Reservations of the node, written back when the block exits"""
+
+        import json
+        import os
+
+        try:
+            import fcntl
+        except ImportError:
+            # Budgets are only shared within the process
+            fcntl = None
+
+        with self.condition, open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                reservations = {}
+                if os.path.exists(self.reservations_path):
+                    with open(self.reservations_path, "r") as content:
+                        reservations = json.loads(content.read() or "{}")
+                reservations = {key: value for key, value in
+                                reservations.items()
+                                if self.is_alive(value["pid"])}
+                yield reservations
+                with open(f"{self.reservations_path}.tmp", "w") as content:
+                    content.write(json.dumps(reservations))
+                os.replace(f"{self.reservations_path}.tmp",
+                           self.reservations_path)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def is_alive(pid):
+        import os
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def fits(self, reservations, disk, memory):
+        if not reservations:
+            return True
+        disk_used = sum(value["disk"] for value in reservations.values())
+        memory_used = sum(value["memory"] for value in reservations.values())
+        return (self.disk_budget is None or
+                disk_used + disk <= self.disk_budget) and \
+            (self.memory_budget is None or
+             memory_used + memory <= self.memory_budget)
+
+    def acquire(self, name, disk, memory):
+        """Wait until the job fits in the budgets and reserve its footprint.
+        Returns the reservation id, the wait in seconds and the number of jobs
+        of the process queued when the job arrived."""
+
+        import os
+        import time
+        import uuid
+
+        reservation_id = uuid.uuid4().hex
+        started = time.perf_counter()
+        with self.condition:
+            self.queued += 1
+            queue_depth = self.queued
+            self.stats["max_queue_depth"] = max(
+                self.stats["max_queue_depth"], queue_depth)
+        try:
+            while True:
+                with self.locked_reservations() as reservations:
+                    if self.fits(reservations, disk, memory):
+                        reservations[reservation_id] = {
+                            "name": name, "pid": os.getpid(), "disk": disk,
+                            "memory": memory, "admitted": time.time()}
+                        break
+                # Releases within the process wake the waiting jobs up, the
+                # ones of other processes are polled
+                with self.condition:
+                    self.condition.wait(self.poll_seconds)
+        finally:
+            with self.condition:
+                self.queued -= 1
+
+        waited = time.perf_counter() - started
+        with self.condition:
+            self.stats["admitted"] += 1
+            self.stats["total_wait_seconds"] += waited
+            self.stats["max_wait_seconds"] = max(
+                self.stats["max_wait_seconds"], waited)
+        return reservation_id, waited, queue_depth
+
+    def release(self, reservation_id):
+        with self.locked_reservations() as reservations:
+            reservations.pop(reservation_id, None)
+        with self.condition:
+            self.condition.notify_all()
+
+    def report(self):
+        """Queue depth of the process, reservations of the node and waits"""
+
+        with self.locked_reservations() as reservations:
+            running = len(reservations)
+            disk = sum(value["disk"] for value in reservations.values())
+            memory = sum(value["memory"] for value in reservations.values())
+        with self.condition:
+            return {"queue_depth": self.queued, "running": running,
+                    "disk_reserved_bytes": disk,
+                    "memory_reserved_bytes": memory,
+                    "disk_budget_bytes": self.disk_budget,
+                    "memory_budget_bytes": self.memory_budget,
+                    **self.stats}
+
+
+# Seekable compressed EDF containers end with a zstd skippable frame holding
+# a JSON index followed by its length and a magic string, so that decoders
+# ignore the index and readers find it in the last bytes of the container
+ZSTD_SKIPPABLE_FRAME_MAGIC = 0x184D2A5E
+EDFZ_INDEX_MAGIC = b"EDFZIDX1"
+EDFZ_FOOTER_SIZE = 12
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("Compressed EDF output requires the zstandard "
+                          "package.") from e
+    return zstandard
+
+
+class CompressedEdfReader():
+    """Reader of the seekable compressed containers written by
+    compress_edf_file. Bytes are fetched with read_range(offset, length),
+    where a negative offset reads the last -offset bytes, e.g. with ranged
+    GETs on an object, so only the frames holding the requested data records
+    are fetched and decompressed."""
+
+    def __init__(self, read_range):
+        import json
+        import struct
+
+        self.read_range = read_range
+        length, magic = struct.unpack(
+            "<I8s", read_range(-EDFZ_FOOTER_SIZE, EDFZ_FOOTER_SIZE))
+        if magic != EDFZ_INDEX_MAGIC:
+            raise ValueError("Not a seekable compressed EDF container.")
+        self.index = json.loads(read_range(-(EDFZ_FOOTER_SIZE + length),
+                                           EDFZ_FOOTER_SIZE + length)[:length])
+
+    @classmethod
+    def from_file(cls, path):
+        def read_range(offset, length):
+            with open(path, "rb") as container:
+                container.seek(offset, 2 if offset < 0 else 0)
+                return container.read(length)
+
+        return cls(read_range)
+
+    def read_frames(self, first_frame, end_frame):
+        """Decompressed bytes of the frames, fetched with one read"""
+
+        frames = self.index["frames"][first_frame:end_frame]
+        if not frames:
+            return b""
+
+        start = frames[0][0]
+        data = self.read_range(start, frames[-1][0] + frames[-1][1] - start)
+        decompressor = _import_zstandard().ZstdDecompressor()
+        return b"".join(decompressor.decompress(
+            data[offset - start:offset - start + size])
+            for offset, size, _, _ in frames)
+
+    def read_header(self):
+        """Main and signal headers, the first frame"""
+
+        return self.read_frames(0, 1)
+
+    def read_records(self, first_record, count):
+        """Bytes of count data records starting at first_record"""
+
+        records_per_frame = self.index["records_per_frame"]
+        record_size = self.index["record_size"]
+        first_record = max(first_record, 0)
+        count = min(count, self.index["num_records"] - first_record)
+        if count <= 0:
+            return b""
+
+        # Frame 0 holds the headers, each next one records_per_frame records
+        first_frame = 1 + first_record // records_per_frame
+        end_frame = 1 - (-(first_record + count) // records_per_frame)
+        data = self.read_frames(first_frame, end_frame)
+        skip = (first_record - (first_frame - 1) * records_per_frame) * \
+            record_size
+        return data[skip:skip + count * record_size]
+
+    def read_window(self, start_seconds, duration_seconds):
+        """Data records covering a time window, relative to the start of the
+        recording. Returns the index of the first record and their bytes."""
+
+        import math
+
+        record_duration = self.index["record_duration"]
+        first_record = int(math.floor(start_seconds / record_duration))
+        end_record = int(math.ceil((start_seconds + duration_seconds) /
+                                   record_duration))
+        first_record = max(first_record, 0)
+        return first_record, self.read_records(first_record,
+                                               end_record - first_record)
+
+    def write_edf(self, dst, batch_frames=16):
+        """Write the exact bytes of the original EDF file to the binary
+        stream dst, batch_frames frames at the time. Returns the size."""
+
+        size = 0
+        for first_frame in range(0, len(self.index["frames"]), batch_frames):
+            data = self.read_frames(first_frame, first_frame + batch_frames)
+            dst.write(data)
+            size += len(data)
+        return size
+
+
+# Labels of the EDF+ and BDF+ signals holding time-stamped annotation lists
+EDF_ANNOTATION_LABELS = ("EDF Annotations", "BDF Annotations")
+
+# Bytes delimiting the texts of a TAL and ending a TAL
+TAL_TEXT_DELIMITER = 0x14
+TAL_END = 0x00
+
+
+class AnnotationScrubber():
+    """Record transform replacing identifiers within the texts of the
+    time-stamped annotation lists (TALs) of the annotation signals with as
+    many fill bytes, so the size of the data records doesn't change. Onsets
+    and durations of the TALs are never modified.
+
+    Identifiers are split into words and matched as case insensitive whole
+    words, i.e. between bytes which are not letters or digits or at the
+    boundaries of a text, with vectorised comparisons over the annotation
+    bytes of a whole batch of records. Words shorter than min_length are not
+    matched, so short names don't hit common clinical terms. The optional
+    regular expression is matched on the same bytes."""
+
+    def __init__(self, identifiers=(), pattern=None, fill="X", min_length=3):
+        import re
+
+        words = {word.encode("utf-8").lower()
+                 for identifier in identifiers
+                 for word in str(identifier).split()
+                 if len(word) >= min_length}
+        # Longer identifiers first, e.g. a surname containing the name
+        self.identifiers = sorted(words, key=len, reverse=True)
+        self.pattern = re.compile(pattern.encode("utf-8"), re.IGNORECASE) \
+            if pattern else None
+        self.fill = fill.encode("latin-1")[:1] or b"X"
+
+    def __bool__(self):
+        return bool(self.identifiers) or self.pattern is not None
+
+    @staticmethod
+    def annotation_signals(layout):
+        return [signal for signal, label in enumerate(layout["labels"])
+                if label in EDF_ANNOTATION_LABELS]
+
+    def __call__(self, records, layout, first_record):
+        import numpy as np
+
+        record_size = layout["record_size"]
+        data = np.frombuffer(records, dtype=np.uint8).reshape(-1, record_size)
+        for signal in self.annotation_signals(layout):
+            start = layout["signal_offsets"][signal]
+            width = layout["samples_per_record"][signal] * \
+                layout["bytes_per_sample"]
+            annotations = data[:, start:start + width]
+            mask = self.scrub_mask(annotations)
+            if mask is not None:
+                annotations[mask] = self.fill[0]
+
+    def scrub_mask(self, annotations):
+        """Mask of the bytes to replace in the annotations of a batch, one row
+        per data record, or None when nothing matches"""
+
+        import numpy as np
+
+        rows, width = annotations.shape
+        flat = annotations.reshape(-1)
+        size = flat.size
+        if size == 0:
+            return None
+
+        # A TAL starts at the beginning of a record or after the end of the
+        # previous one, its texts follow its first delimiter
+        is_delimiter = flat == TAL_TEXT_DELIMITER
+        is_end = flat == TAL_END
+        begins = np.zeros(size, dtype=bool)
+        begins[::width] = True
+        begins[1:] |= is_end[:-1]
+        delimiters_before = np.cumsum(is_delimiter) - is_delimiter
+        tal = np.cumsum(begins) - 1
+        in_text = (delimiters_before -
+                   delimiters_before[np.flatnonzero(begins)][tal] >= 1) & \
+            ~is_delimiter & ~is_end
+        if not in_text.any():
+            return None
+
+        # Matches are kept when all of their bytes are text
+        outside_text = np.concatenate(([0], np.cumsum(~in_text)))
+
+        def within_text(starts, lengths):
+            return outside_text[starts + lengths] == outside_text[starts]
+
+        lowered = np.where((flat >= ord("A")) & (flat <= ord("Z")),
+                           flat + (ord("a") - ord("A")), flat).astype(np.uint8)
+
+        # Identifiers only match whole words, bytes of UTF-8 sequences are
+        # taken as letters
+        is_word = in_text & (((lowered >= ord("a")) & (lowered <= ord("z"))) |
+                             ((flat >= ord("0")) & (flat <= ord("9"))) |
+                             (flat >= 0x80))
+        is_word = np.concatenate(([False], is_word, [False]))
+
+        def whole_word(starts, lengths):
+            return ~is_word[starts] & ~is_word[starts + lengths + 1]
+        changes = np.zeros(size + 1, dtype=np.int64)
+
+        for identifier in self.identifiers:
+            length = len(identifier)
+            if length > size:
+                continue
+            # Candidates are narrowed down one byte of the identifier at the
+            # time, only the surviving positions are compared
+            starts = np.flatnonzero(lowered[:size - length + 1] ==
+                                    identifier[0])
+            for position in range(1, length):
+                if not starts.size:
+                    break
+                starts = starts[lowered[starts + position] ==
+                                identifier[position]]
+            starts = starts[within_text(starts, length) &
+                            whole_word(starts, length)]
+            np.add.at(changes, starts, 1)
+            np.add.at(changes, starts + length, -1)
+
+        if self.pattern is not None:
+            spans = np.array([match.span() for match in
+                              self.pattern.finditer(flat.tobytes())
+                              if match.end() > match.start()],
+                             dtype=np.int64).reshape(-1, 2)
+            spans = spans[within_text(spans[:, 0], spans[:, 1] - spans[:, 0])]
+            np.add.at(changes, spans[:, 0], 1)
+            np.add.at(changes, spans[:, 1], -1)
+
+        mask = np.cumsum(changes[:size]) > 0
+        if not mask.any():
+            return None
+        return mask.reshape(rows, width)
 
 class GenericPlugin(EmptyPlugin):
-    def execute_sql_on_trino(self, sql, conn):
-        """Generic function to execute a SQL statement"""
+    def __getstate__(self):
+        """Only the plugin configuration is sent to worker processes, runtime
+        objects like locks, pools and clients are created again there"""
+
+        return {key: value for key, value in self.__dict__.items()
+                if key.startswith("__")}
+
+    def get_config_value(self, key, default=None, cast=str):
+        """Return the value of an optional plugin configuration key, casted to
+        the expected type, or the default value if it is missing or empty"""
+
+        value = self.__dict__.get(f"__{key.upper()}__")
+        if value is None or value.strip() == "":
+            return default
+        if cast is bool:
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        return cast(value.strip())
+
+    def execute_sql_on_trino(self, sql, conn, params=None):
+        """Generic function to execute a SQL statement, with optional qmark
+        style parameters"""
 
         # Get a cursor from the connection object
         cur = conn.cursor()
 
         # Execute sql statement
-        cur.execute(sql)
+        if params:
+            cur.execute(sql, params)
+        else:
+            cur.execute(sql)
 
         # Get the results from the cluster
         rows = cur.fetchall()
@@ -48,67 +1334,855 @@ class GenericPlugin(EmptyPlugin):
 
         return data
 
-    def upload_data_on_trino(self, schema_name, table_name, data, conn):
-        """Create sql statement for inserting data and update
-        the table with data"""
-
-        # Iterate through pandas dataframe to extract each row values
-        data_list = []
-        for row in data.itertuples(index=False):
-            data_list.append(str(tuple(row)))
-        data_to_insert = ", ".join(data_list)
-
-        # Insert data into the table
-        sql_statement = "INSERT INTO iceberg.{schema_name}.{table_name} VALUES \
-              {data}".format(schema_name=schema_name,
-                             table_name=table_name,
-                             data=data_to_insert)
-        self.execute_sql_on_trino(sql=sql_statement, conn=conn)
+    def upload_data_on_trino(self, schema_name, table_name, data, conn,
+                             chunk_rows=None):
+        """Insert the data into the table with parameterised multi row INSERT
+        statements, chunk_rows rows at the time, and report the insert rate"""
+
+        import time
+
+        if chunk_rows is None:
+            chunk_rows = self.get_config_value("TRINO_INSERT_CHUNK_ROWS", 1000,
+                                               int)
+
+        # Parameters must be python objects, not numpy scalars
+        rows = data.astype(object).values.tolist()
+        row_placeholder = "({})".format(", ".join(["?"] * len(data.columns)))
+
+        started = time.perf_counter()
+        for start in range(0, len(rows), chunk_rows):
+            chunk = rows[start:start + chunk_rows]
+            sql_statement = (
+                "INSERT INTO iceberg.{schema_name}.{table_name} "
+                "VALUES {values}").format(
+                    schema_name=schema_name, table_name=table_name,
+                    values=", ".join([row_placeholder] * len(chunk)))
+            self.execute_sql_on_trino(
+                sql=sql_statement, conn=conn,
+                params=[value for row in chunk for value in row])
+        elapsed = time.perf_counter() - started
+
+        rows_per_second = len(rows) / elapsed if elapsed > 0 else 0.0
+        print(f"Inserted {len(rows)} rows into {schema_name}.{table_name} in "
+              f"{elapsed:.2f} s ({rows_per_second:.0f} rows/s)")
+
+        return {"rows": len(rows), "seconds": elapsed,
+                "rows_per_second": rows_per_second}
+
+    def delete_data_on_trino(self, schema_name, table_name, source_name,
+                             workspace_id, conn):
+        """Delete the rows of a source file, e.g. left by an interrupted
+        insert"""
+
+        sql_statement = ("DELETE FROM iceberg.{schema_name}.{table_name} "
+                         "WHERE source = ? "
+                         "AND workspace_id IS NOT DISTINCT FROM ?").format(
+                             schema_name=schema_name, table_name=table_name)
+        self.execute_sql_on_trino(sql=sql_statement, conn=conn,
+                                  params=[source_name, workspace_id])
+
+    def get_s3_client(self, local=False):
+        """Return the shared S3 client of the local or of the remote object
+        storage. Clients are cached for the lifetime of the process and are
+        safe to use from several threads."""
+
+        if local:
+            return _S3_CLIENTS.get_client(
+                self.__OBJ_STORAGE_URL_LOCAL__,
+                self.__OBJ_STORAGE_ACCESS_ID_LOCAL__,
+                self.__OBJ_STORAGE_ACCESS_SECRET_LOCAL__,
+                self.__OBJ_STORAGE_REGION__,
+                max_pool_connections=self.get_config_value(
+                    "OBJ_STORAGE_MAX_POOL_CONNECTIONS", 10, int),
+                tcp_keepalive=self.get_config_value(
+                    "OBJ_STORAGE_TCP_KEEPALIVE", True, bool))
+
+        return _S3_CLIENTS.get_client(
+            self.__OBJ_STORAGE_URL__,
+            self.__OBJ_STORAGE_ACCESS_ID__,
+            self.__OBJ_STORAGE_ACCESS_SECRET__,
+            self.__OBJ_STORAGE_REGION__,
+            max_pool_connections=self.get_config_value(
+                "OBJ_STORAGE_MAX_POOL_CONNECTIONS", 10, int),
+            tcp_keepalive=self.get_config_value(
+                "OBJ_STORAGE_TCP_KEEPALIVE", True, bool))
+
+    def get_transfer_config(self, local=False):
+        """Multipart transfer settings of the local or of the remote object
+        storage, sizes are configured in MB"""
+
+        from boto3.s3.transfer import TransferConfig
+
+        suffix = "_LOCAL" if local else ""
+        megabyte = 1024 * 1024
+        return TransferConfig(
+            multipart_threshold=self.get_config_value(
+                f"OBJ_STORAGE_MULTIPART_THRESHOLD_MB{suffix}", 8,
+                int) * megabyte,
+            multipart_chunksize=self.get_config_value(
+                f"OBJ_STORAGE_MULTIPART_CHUNKSIZE_MB{suffix}", 8,
+                int) * megabyte,
+            max_concurrency=self.get_config_value(
+                f"OBJ_STORAGE_MAX_CONCURRENCY{suffix}", 10, int))
+
+    def get_checksum_args(self, local=False, download=False):
+        """Extra arguments enabling the checksum of each uploaded or copied
+        part with the configured algorithm (e.g. CRC32), and the validation of
+        downloaded data. Empty when OBJ_STORAGE_CHECKSUM_ALGORITHM is not
+        set."""
+
+        suffix = "_LOCAL" if local else ""
+        algorithm = self.get_config_value(
+            f"OBJ_STORAGE_CHECKSUM_ALGORITHM{suffix}")
+        if algorithm is None:
+            return {}
+        if download:
+            return {'ChecksumMode': 'ENABLED'}
+        return {'ChecksumAlgorithm': algorithm.upper()}
+
+    def log_transfer(self, action, name, size, started):
+        """Print the throughput of a transfer"""
+
+        import time
+
+        elapsed = time.perf_counter() - started
+        megabytes = size / (1024 * 1024)
+        rate = megabytes / elapsed if elapsed > 0 else 0.0
+        print(f"{action} {name}: {megabytes:.1f} MB in {elapsed:.2f} s "
+              f"({rate:.1f} MB/s)")
+
+    def list_object_keys(self, s3_client, bucket, prefix):
+        """Iterate over the keys of all the objects under the prefix"""
+
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"]
+
+    def copy_object(self, s3_client, bucket, source_key, destination_key):
+        """Copy an object within the bucket on the server side, large objects
+        are copied in parts with UploadPartCopy"""
+
+        s3_client.copy({'Bucket': bucket, 'Key': source_key}, bucket,
+                       destination_key,
+                       ExtraArgs=self.get_checksum_args(local=True) or None,
+                       Config=self.get_transfer_config(local=True))
 
     def download_file(self, path_download_file:str, file_name:str) -> None:
-        import boto3
-        from botocore.client import Config
+        """Download the file to anonymize and, at the same time, move the
+        original to EEGs/edf/ with a server side copy"""
+
         import os
+        import time
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        s3_local = self.get_s3_client(local=True)
+        bucket_local = self.__OBJ_STORAGE_BUCKET_LOCAL__
+
+        def download():
+            started = time.perf_counter()
+            s3_local.download_file(
+                bucket_local, file_name, path_download_file,
+                ExtraArgs=self.get_checksum_args(local=True, download=True)
+                    or None,
+                Config=self.get_transfer_config(local=True))
+            self.log_transfer("Downloaded", file_name,
+                              os.path.getsize(path_download_file), started)
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            # Download data which need to be anonymized
+            downloaded = pool.submit(download)
+            # Rename the original file in bucket, the data doesn't leave the
+            # object storage
+            copied = pool.submit(
+                self.copy_object, s3_local, bucket_local, file_name,
+                "EEGs/edf/" + os.path.basename(path_download_file))
+            wait([downloaded, copied])
+
+        downloaded.result()
+        copied.result()
+
+        # The temporary object is only removed once it has been both
+        # downloaded and copied
+        s3_local.delete_object(
+            Bucket=bucket_local,
+            Key="edf_data_tmp/" + os.path.basename(file_name))
+
+    def anonymize_object(self, source_key, destination_key, to_remove,
+                         new_values, annotation_scrubber=None):
+        """Anonymize an edf object of the local object storage into the remote
+        one without staging it on disk. Only the headers are fetched, with
+        ranged GETs, and patched in memory. The destination is written as a
+        multipart upload whose first part is the new header followed by the
+        start of the data records, the other parts are copied from the
+        original with UploadPartCopy when both objects are in the same
+        storage, or streamed part by part otherwise. When an annotation
+        scrubber is given and the file has annotation signals, every part is
+        streamed through it, with parts holding whole data records. Returns
+        the parsed headers of the original file."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        s3_local = self.get_s3_client(local=True)
+        s3 = self.get_s3_client(local=False)
+        bucket_local = self.__OBJ_STORAGE_BUCKET_LOCAL__
+        bucket = self.__OBJ_STORAGE_BUCKET__
+
+        def get_range(start, end):
+            return s3_local.get_object(Bucket=bucket_local, Key=source_key,
+                                       Range=f"bytes={start}-{end - 1}")
+
+        response = get_range(0, EDF_MAIN_HEADER_SIZE)
+        object_size = int(response["ContentRange"].split("/")[-1])
+        main_header = response["Body"].read()
+        num_signals = int(main_header[EDF_NUM_SIGNALS_FIELD[0]:].strip())
+        header_bytes = EDF_MAIN_HEADER_SIZE * (num_signals + 1)
+        header = main_header + get_range(EDF_MAIN_HEADER_SIZE,
+                                         header_bytes)["Body"].read()
+        layout = self.parse_edf_record_layout(header)
+
+        # Every part but the last one must be at least 5 MB, so the first part
+        # carries the start of the data records too, at least the first record
+        transfer_config = self.get_transfer_config(local=False)
+        part_size = max(transfer_config.multipart_chunksize, 5 * 1024 * 1024)
+        first_part_end = min(object_size,
+                             max(part_size,
+                                 header_bytes + layout["record_size"]))
+
+        record_transform = None
+        if annotation_scrubber and layout["record_size"] > 0 and \
+                annotation_scrubber.annotation_signals(layout):
+            record_transform = annotation_scrubber
+            # Parts start at a data record, so records are transformed whole
+            part_size = -(-part_size // layout["record_size"]) * \
+                layout["record_size"]
+            first_part_end = min(object_size, header_bytes + part_size)
+
+        def transform(body, start):
+            """Pass the whole data records of a part, starting at byte start
+            of the file, through the record transform"""
+
+            if record_transform is None:
+                return body
+            body = bytearray(body)
+            skip = max(header_bytes - start, 0)
+            first_record = (start + skip - header_bytes) // \
+                layout["record_size"]
+            full_records = (len(body) - skip) // layout["record_size"]
+            if full_records > 0:
+                record_transform(
+                    memoryview(body)[skip:skip +
+                                     full_records * layout["record_size"]],
+                    layout, first_record)
+            return bytes(body)
+
+        head = header
+        if first_part_end > header_bytes:
+            # Files without data records are only made of their headers
+            head += get_range(header_bytes, first_part_end)["Body"].read()
+
+        edf_info = self.parse_edf_header(head, file_size=object_size)
+        first_part = transform(
+            self.patch_edf_header(main_header, to_remove, new_values) +
+            head[EDF_MAIN_HEADER_SIZE:], 0)
+
+        if first_part_end >= object_size:
+            s3.put_object(Bucket=bucket, Key=destination_key, Body=first_part)
+            return edf_info
+
+        # UploadPartCopy only works within the same object storage
+        same_storage = \
+            self.__OBJ_STORAGE_URL_LOCAL__ == self.__OBJ_STORAGE_URL__ and \
+            self.__OBJ_STORAGE_ACCESS_ID_LOCAL__ == \
+            self.__OBJ_STORAGE_ACCESS_ID__
+
+        upload_id = s3.create_multipart_upload(
+            Bucket=bucket, Key=destination_key)["UploadId"]
+
+        def upload_part(part_number, start, end):
+            if part_number == 1:
+                response = s3.upload_part(
+                    Bucket=bucket, Key=destination_key, UploadId=upload_id,
+                    PartNumber=part_number, Body=first_part)
+                etag = response["ETag"]
+            elif same_storage and record_transform is None:
+                response = s3.upload_part_copy(
+                    Bucket=bucket, Key=destination_key, UploadId=upload_id,
+                    PartNumber=part_number,
+                    CopySource={'Bucket': bucket_local, 'Key': source_key},
+                    CopySourceRange=f"bytes={start}-{end - 1}")
+                etag = response["CopyPartResult"]["ETag"]
+            else:
+                body = transform(get_range(start, end)["Body"].read(), start)
+                response = s3.upload_part(
+                    Bucket=bucket, Key=destination_key, UploadId=upload_id,
+                    PartNumber=part_number, Body=body)
+                etag = response["ETag"]
+            return {"ETag": etag, "PartNumber": part_number}
+
+        ranges = [(1, 0, first_part_end)]
+        for start in range(first_part_end, object_size, part_size):
+            ranges.append((len(ranges) + 1, start,
+                           min(start + part_size, object_size)))
 
-        s3_local = boto3.resource('s3',
-                                  endpoint_url=self.__OBJ_STORAGE_URL_LOCAL__,
-                                  aws_access_key_id=\
-                                    self.__OBJ_STORAGE_ACCESS_ID_LOCAL__,
-                                  aws_secret_access_key=\
-                                    self.__OBJ_STORAGE_ACCESS_SECRET_LOCAL__,
-                                  config=Config(signature_version='s3v4'),
-                                  region_name=self.__OBJ_STORAGE_REGION__)
-
-        # Download data which need to be anonymized
-        s3_local.Bucket(self.__OBJ_STORAGE_BUCKET_LOCAL__).download_file(
-            file_name, path_download_file)
-
-        # In order to rename the original file in bucket we need to delete
-        # it and upload it again
-        s3_local.Object(self.__OBJ_STORAGE_BUCKET_LOCAL__,
-                        "edf_data_tmp/" + os.path.basename(file_name)).delete()
-        s3_local.Bucket(self.__OBJ_STORAGE_BUCKET_LOCAL__).upload_file(
-            path_download_file,
-            "EEGs/edf/" + os.path.basename(path_download_file))
-
-    def anonymize_edf_file(self, signals, signal_headers, header, new_file_name,
-                           to_remove, new_values):
-        """Anonymize edf file by removing values of personal data in header
-        fields."""
+        try:
+            with ThreadPoolExecutor(
+                    max_workers=transfer_config.max_concurrency) as pool:
+                parts = list(pool.map(lambda part: upload_part(*part),
+                                      ranges))
+            s3.complete_multipart_upload(
+                Bucket=bucket, Key=destination_key, UploadId=upload_id,
+                MultipartUpload={"Parts": parts})
+        except Exception:
+            s3.abort_multipart_upload(Bucket=bucket, Key=destination_key,
+                                      UploadId=upload_id)
+            raise
+
+        return edf_info
+
+    def anonymize_file_diskless(self, file_name, source_name, anonymized_name,
+                                to_remove, new_values,
+                                annotation_scrubber=None):
+        """Anonymize the file with anonymize_object and, at the same time, move
+        the original to EEGs/edf/ with a server side copy. Returns the parsed
+        headers of the original file."""
+
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        s3_local = self.get_s3_client(local=True)
+        bucket_local = self.__OBJ_STORAGE_BUCKET_LOCAL__
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            anonymized = pool.submit(self.anonymize_object, file_name,
+                                     "EEGs/edf/" + anonymized_name,
+                                     to_remove, new_values,
+                                     annotation_scrubber)
+            copied = pool.submit(self.copy_object, s3_local, bucket_local,
+                                 file_name, "EEGs/edf/" + source_name)
+            wait([anonymized, copied])
+
+        edf_info = anonymized.result()
+        copied.result()
+
+        s3_local.delete_object(Bucket=bucket_local, Key=file_name)
+
+        return edf_info
+
+    def patch_edf_subfields(self, field, subfields, to_remove, new_values):
+        """Replace EDF+ subfields of the local patient or local recording
+        identification field. Empty values are written as "X" (unknown) and
+        empty additional subfields are dropped, as pyedflib does."""
+
+        values = field.split()
+        additional_index = max(subfields.values())
 
-        import os
+        for new_val, attr in zip(new_values, to_remove):
+            if attr not in subfields:
+                continue
+            index = subfields[attr]
+            # Spaces separate the subfields so they are not allowed in values
+            new_val = "_".join(str(new_val).split())
+            values.extend(["X"] * (index + 1 - len(values)))
+            if index == additional_index:
+                values[index:] = [new_val] if new_val else []
+            else:
+                values[index] = new_val or "X"
+
+        return " ".join(values)
+
+    def patch_edf_header(self, main_header, to_remove, new_values):
+        """Return a copy of the 256 bytes EDF main header with the personal
+        data fields replaced, all the other bytes are left untouched."""
 
         if not len(to_remove) == len(new_values):
             raise AssertionError('Each to_remove must have one new_value')
 
-        # Remove personal information from header
-        for new_val, attr in zip(new_values, to_remove):
-            if attr in header.keys():
-                header[attr] = new_val
+        if len(main_header) < EDF_MAIN_HEADER_SIZE:
+            raise ValueError("EDF main header is truncated.")
+
+        main_header = bytearray(main_header[:EDF_MAIN_HEADER_SIZE])
+        reserved_start, reserved_width = EDF_RESERVED_FIELD
+        reserved = bytes(main_header[reserved_start:
+                                     reserved_start + reserved_width])
+        is_edfplus = reserved[:4] in (b"EDF+", b"BDF+")
+
+        for (start, width), subfields in \
+                [(EDF_PATIENT_FIELD, EDFPLUS_PATIENT_SUBFIELDS),
+                 (EDF_RECORDING_FIELD, EDFPLUS_RECORDING_SUBFIELDS)]:
+            if not any(attr in subfields for attr in to_remove):
+                continue
+
+            if is_edfplus:
+                field = main_header[start:start + width].decode("latin-1")
+                field = self.patch_edf_subfields(field, subfields, to_remove,
+                                                 new_values)
+            else:
+                # Plain EDF identification fields are free text, so the whole
+                # field is blanked
+                field = ""
+
+            field = field.encode("latin-1", errors="replace")
+            if len(field) > width:
+                raise ValueError(f"Anonymized header field {field!r} is "
+                                 f"longer than {width} characters.")
+            main_header[start:start + width] = field.ljust(width)
+
+        return bytes(main_header)
+
+    def parse_edf_record_layout(self, header):
+        """Compute the layout of the data records from the main header and the
+        signal headers, without touching the data records"""
+
+        def field(start, width):
+            return header[start:start + width].decode("latin-1").strip()
+
+        num_signals = int(field(*EDF_NUM_SIGNALS_FIELD))
+        header_bytes = EDF_MAIN_HEADER_SIZE * (num_signals + 1)
+        if len(header) < header_bytes:
+            raise ValueError("EDF signal headers are truncated.")
+
+        # Offset of the number of samples in a data record, for each signal
+        offset = EDF_MAIN_HEADER_SIZE
+        for name, width in EDF_SIGNAL_HEADER_FIELDS:
+            if name == "samples_per_record":
+                break
+            offset += width * num_signals
+        samples_per_record = [int(field(offset + i * 8, 8))
+                              for i in range(num_signals)]
+        labels = [field(EDF_MAIN_HEADER_SIZE + i * 16, 16)
+                  for i in range(num_signals)]
+
+        # BDF files store samples in 3 bytes instead of 2
+        bytes_per_sample = 3 if header[:1] == b"\xff" else 2
+
+        signal_offsets = []
+        record_size = 0
+        for samples in samples_per_record:
+            signal_offsets.append(record_size)
+            record_size += samples * bytes_per_sample
+
+        return {"header_bytes": header_bytes,
+                "num_records": int(field(*EDF_NUM_RECORDS_FIELD)),
+                "record_duration": float(field(*EDF_RECORD_DURATION_FIELD)),
+                "num_signals": num_signals,
+                "labels": labels,
+                "samples_per_record": samples_per_record,
+                "bytes_per_sample": bytes_per_sample,
+                "signal_offsets": signal_offsets,
+                "record_size": record_size}
+
+    def parse_edf_subfields(self, field, subfields):
+        """Split an EDF+ identification field into the pyedflib header keys.
+        Like edflib, "X" (unknown) is returned as an empty value for all the
+        subfields but the patient name"""
+
+        values = field.split()
+        additional_index = max(subfields.values())
+        parsed = {}
+        for attr, index in subfields.items():
+            if index == additional_index:
+                value = " ".join(values[index:])
+            else:
+                value = values[index] if index < len(values) else ""
+                if value == "X" and attr != "patientname":
+                    value = ""
+                value = value.replace("_", " ")
+            parsed[attr] = value
+        return parsed
+
+    def parse_edf_header(self, buffer, file_size=None):
+        """Parse the main header and the signal headers of an edf file from a
+        bytes-like buffer without decoding any sample. The header, signal
+        headers and start datetime are returned with the same keys and values
+        as pyedflib. If the buffer also holds the first data record the
+        subsecond start time of EDF+ files is read from it. file_size is used
+        when the number of data records is not set in the header."""
+
+        import datetime
+
+        main_header = bytes(buffer[:EDF_MAIN_HEADER_SIZE])
+        if len(main_header) < EDF_MAIN_HEADER_SIZE:
+            raise ValueError("EDF main header is truncated.")
+
+        num_signals = int(main_header[EDF_NUM_SIGNALS_FIELD[0]:].strip())
+        header_bytes = EDF_MAIN_HEADER_SIZE * (num_signals + 1)
+        header = bytes(buffer[:header_bytes])
+        layout = self.parse_edf_record_layout(header)
+
+        def field(start, width):
+            return header[start:start + width].decode("latin-1").strip()
+
+        reserved = field(*EDF_RESERVED_FIELD)
+        is_edfplus = reserved[:4] in ("EDF+", "BDF+")
+
+        # Signal header fields are stored field by field for all the signals
+        signal_fields = {}
+        offset = EDF_MAIN_HEADER_SIZE
+        for name, width in EDF_SIGNAL_HEADER_FIELDS:
+            signal_fields[name] = [field(offset + i * width, width)
+                                   for i in range(num_signals)]
+            offset += width * num_signals
+
+        record_duration = layout["record_duration"]
+        annotation_signals = []
+        signal_headers = []
+        for i in range(num_signals):
+            label = signal_fields["label"][i]
+            if is_edfplus and label in ("EDF Annotations", "BDF Annotations"):
+                annotation_signals.append(i)
+                continue
+            samples = layout["samples_per_record"][i]
+            signal_headers.append({
+                'label': label,
+                'dimension': signal_fields["dimension"][i],
+                'sample_frequency': samples / record_duration \
+                    if record_duration > 0 else float(samples),
+                'physical_max': float(signal_fields["physical_max"][i]),
+                'physical_min': float(signal_fields["physical_min"][i]),
+                'digital_max': int(signal_fields["digital_max"][i]),
+                'digital_min': int(signal_fields["digital_min"][i]),
+                'prefilter': signal_fields["prefilter"][i],
+                'transducer': signal_fields["transducer"][i]})
+
+        # Main header
+        header_info = {}
+        patient = field(*EDF_PATIENT_FIELD)
+        recording = field(*EDF_RECORDING_FIELD)
+        if is_edfplus:
+            header_info.update(self.parse_edf_subfields(
+                patient, EDFPLUS_PATIENT_SUBFIELDS))
+            header_info.update(self.parse_edf_subfields(
+                recording, EDFPLUS_RECORDING_SUBFIELDS))
+            header_info["sex"] = {"M": "Male", "F": "Female"}.get(
+                header_info["sex"], header_info["sex"])
+            header_info["gender"] = header_info["sex"]
+            header_info["birthdate"] = \
+                header_info["birthdate"].replace("-", " ").lower()
+        else:
+            header_info.update({attr: "" for attr in
+                                list(EDFPLUS_PATIENT_SUBFIELDS) +
+                                list(EDFPLUS_RECORDING_SUBFIELDS)})
+
+        # Start datetime, EDF+ files keep the 4 digits year in the recording
+        # field and the subsecond start time in the first annotation
+        day, month, year = (int(value) for value in
+                            field(*EDF_STARTDATE_FIELD).split("."))
+        hour, minute, second = (int(value) for value in
+                                field(*EDF_STARTTIME_FIELD).split("."))
+        year += 1900 if year >= 85 else 2000
+        recording_subfields = recording.split()
+        if is_edfplus and len(recording_subfields) > 1 and \
+                recording_subfields[0] == "Startdate":
+            try:
+                year = datetime.datetime.strptime(recording_subfields[1],
+                                                  "%d-%b-%Y").year
+            except ValueError:
+                pass
+
+        microsecond = 0
+        record_end = header_bytes + layout["record_size"]
+        if annotation_signals and len(buffer) >= record_end:
+            index = annotation_signals[0]
+            start = header_bytes + layout["signal_offsets"][index]
+            size = layout["samples_per_record"][index] * \
+                layout["bytes_per_sample"]
+            tal = bytes(buffer[start:start + size])
+            onset = tal.split(b"\x14", 1)[0].decode("latin-1")
+            if "." in onset:
+                fraction = onset.split(".", 1)[1][:7].ljust(7, "0")
+                microsecond = round(int(fraction) / 10)
+
+        startdate = datetime.datetime(year, month, day, hour, minute, second,
+                                      microsecond)
+        header_info["startdate"] = startdate
+
+        # Duration of the signal, the number of data records can be -1 while
+        # the file is being recorded
+        num_records = layout["num_records"]
+        if num_records < 0 and file_size is not None and \
+                layout["record_size"] > 0:
+            num_records = (file_size - header_bytes) // layout["record_size"]
+        duration = max(num_records, 0) * record_duration
+
+        return {"header": header_info,
+                "SignalHeaders": signal_headers,
+                "startdate": startdate,
+                "Duration": duration,
+                "layout": layout}
+
+    def read_edf_header_mmap(self, path_to_file):
+        """Parse the headers of an edf file from a read only memory mapping,
+        only the pages holding the headers and the first data record are
+        read from disk"""
+
+        import mmap
+        import os
+
+        file_size = os.path.getsize(path_to_file)
+        with open(path_to_file, "rb") as edf_file, \
+                mmap.mmap(edf_file.fileno(), 0,
+                          access=mmap.ACCESS_READ) as mapping:
+            num_signals = int(mapping[EDF_NUM_SIGNALS_FIELD[0]:
+                                      EDF_MAIN_HEADER_SIZE].strip())
+            header_bytes = EDF_MAIN_HEADER_SIZE * (num_signals + 1)
+            layout = self.parse_edf_record_layout(mapping[:header_bytes])
+            return self.parse_edf_header(
+                mapping[:header_bytes + layout["record_size"]],
+                file_size=file_size)
+
+    def stream_edf_records(self, src, dst, layout, record_transform,
+                           batch_records=None):
+        """Copy the data records from src to dst in batches of batch_records
+        records, so only one batch is held in memory at the time.
+        record_transform(records, layout, first_record) is called on each batch
+        and may modify the records in place, but can't change their size."""
+
+        if batch_records is None:
+            batch_records = self.get_config_value(
+                "EDF_STREAM_BATCH_RECORDS", DEFAULT_STREAM_BATCH_RECORDS, int)
+
+        record_size = layout["record_size"]
+        buffer = bytearray(max(batch_records, 1) * record_size)
+        view = memoryview(buffer)
+        first_record = 0
+
+        while True:
+            # Fill the whole batch, streams may return less than requested
+            read = 0
+            while read < len(buffer):
+                size = src.readinto(view[read:])
+                if not size:
+                    break
+                read += size
+            if not read:
+                break
+
+            # Incomplete trailing record is copied as it is
+            full_records = read // record_size
+            if full_records > 0:
+                record_transform(view[:full_records * record_size], layout,
+                                 first_record)
+            dst.write(view[:read])
+            first_record += full_records
+            if read < len(buffer):
+                break
+
+    def anonymize_edf_header(self, path_to_file, new_file_name, to_remove,
+                             new_values, record_transform=None,
+                             batch_records=None, chunk_size=16 * 1024 * 1024):
+        """Anonymize edf file by rewriting the personal data fields of the main
+        header only. Signal headers and data records are copied byte for byte
+        without being decoded, unless record_transform is given, then the data
+        records are streamed through it in batches. If new_file_name is None
+        the file is patched in place."""
+
+        import shutil
+
+        if new_file_name is None and record_transform is not None:
+            raise ValueError("Streaming the data records requires a new file.")
+
+        if new_file_name is None:
+            with open(path_to_file, "r+b") as edf_file:
+                main_header = edf_file.read(EDF_MAIN_HEADER_SIZE)
+                edf_file.seek(0)
+                edf_file.write(self.patch_edf_header(main_header, to_remove,
+                                                     new_values))
+            return
+
+        with open(path_to_file, "rb") as src, open(new_file_name, "wb") as dst:
+            main_header = src.read(EDF_MAIN_HEADER_SIZE)
+            dst.write(self.patch_edf_header(main_header, to_remove,
+                                            new_values))
+            if record_transform is None:
+                shutil.copyfileobj(src, dst, chunk_size)
+                return
+
+            num_signals = int(main_header[EDF_NUM_SIGNALS_FIELD[0]:].strip())
+            signal_headers = src.read(EDF_SIGNAL_HEADER_SIZE * num_signals)
+            dst.write(signal_headers)
+            layout = self.parse_edf_record_layout(main_header + signal_headers)
+            self.stream_edf_records(src, dst, layout, record_transform,
+                                    batch_records)
+
+    def get_annotation_scrubber(self, data_info):
+        """Scrubber of the name, surname, unique_id and MRN of the patient and
+        of the ANNOTATION_SCRUB_PATTERN regular expression in the annotation
+        texts, or None when scrubbing is disabled or there is nothing to
+        look for"""
+
+        if not self.get_config_value("ANNOTATION_SCRUBBING", True, bool):
+            return None
+
+        identifiers = [data_info.get(key) for key in
+                       ['name', 'surname', 'unique_id', 'MRN']
+                       if data_info.get(key) is not None]
+        scrubber = AnnotationScrubber(
+            identifiers, pattern=self.get_config_value(
+                "ANNOTATION_SCRUB_PATTERN"),
+            fill=self.get_config_value("ANNOTATION_SCRUB_FILL", "X"),
+            min_length=self.get_config_value(
+                "ANNOTATION_SCRUB_MIN_LENGTH", 3, int))
+        return scrubber if scrubber else None
+
+    def compress_edf_file(self, path_to_file, output_path, level=None,
+                          frame_size=None, threads=None):
+        """Write the edf file as a seekable compressed container: the headers
+        and each group of data records are independent zstd frames, so any
+        zstd decoder restores the exact file, followed by the index of the
+        frames. Frames hold as many whole records as fit in frame_size bytes,
+        and are compressed on threads threads. Returns the index."""
+
+        import json
+        import struct
+        from concurrent.futures import ThreadPoolExecutor
+
+        zstd = _import_zstandard()
+
+        if level is None:
+            level = self.get_config_value("COMPRESSION_LEVEL", 3, int)
+        if frame_size is None:
+            frame_size = int(self.get_config_value(
+                "COMPRESSION_FRAME_SIZE_MB", 4.0, float) * 1024 * 1024)
+        if threads is None:
+            threads = self.get_config_value("COMPRESSION_THREADS", 1, int)
+        threads = max(threads, 1)
+
+        def compress(chunk):
+            # Compressors are not thread safe, one per frame
+            return zstd.ZstdCompressor(level=level,
+                                       write_checksum=True).compress(chunk)
+
+        # Compressed offset, compressed size, offset and size of each frame
+        frames = []
+
+        def write_frame(dst, chunk, compressed):
+            offset, size = (frames[-1][0] + frames[-1][1],
+                            frames[-1][2] + frames[-1][3]) if frames \
+                else (0, 0)
+            dst.write(compressed)
+            frames.append([offset, len(compressed), size, len(chunk)])
+
+        with open(path_to_file, "rb") as src, \
+                open(output_path, "wb") as dst, \
+                ThreadPoolExecutor(max_workers=threads) as pool:
+            main_header = src.read(EDF_MAIN_HEADER_SIZE)
+            num_signals = int(main_header[EDF_NUM_SIGNALS_FIELD[0]:].strip())
+            header = main_header + \
+                src.read(EDF_SIGNAL_HEADER_SIZE * num_signals)
+            layout = self.parse_edf_record_layout(header)
+            record_size = max(layout["record_size"], 1)
+            records_per_frame = max(frame_size // record_size, 1)
+
+            write_frame(dst, header, compress(header))
+
+            # A few frames per thread are read ahead, never the whole file
+            while True:
+                chunks = []
+                for _ in range(2 * threads):
+                    chunk = src.read(records_per_frame * record_size)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                if not chunks:
+                    break
+                for chunk, compressed in zip(chunks,
+                                             pool.map(compress, chunks)):
+                    write_frame(dst, chunk, compressed)
+
+            uncompressed_size = frames[-1][2] + frames[-1][3]
+            index = {"version": 1,
+                     "header_bytes": layout["header_bytes"],
+                     "record_size": layout["record_size"],
+                     "record_duration": layout["record_duration"],
+                     "num_records": (uncompressed_size -
+                                     layout["header_bytes"]) // record_size,
+                     "records_per_frame": records_per_frame,
+                     "uncompressed_size": uncompressed_size,
+                     "frames": frames}
+            content = json.dumps(index, separators=(",", ":")).encode()
+            payload = content + struct.pack("<I8s", len(content),
+                                            EDFZ_INDEX_MAGIC)
+            dst.write(struct.pack("<II", ZSTD_SKIPPABLE_FRAME_MAGIC,
+                                  len(payload)) + payload)
+
+        return index
+
+    def open_compressed_edf(self, obj_name, local=False):
+        """Reader of a compressed container in the object storage, fetching
+        the index and the frames with ranged GETs"""
+
+        s3 = self.get_s3_client(local=local)
+        bucket = self.__OBJ_STORAGE_BUCKET_LOCAL__ if local \
+            else self.__OBJ_STORAGE_BUCKET__
+
+        def read_range(offset, length):
+            byte_range = f"bytes={offset}" if offset < 0 \
+                else f"bytes={offset}-{offset + length - 1}"
+            return s3.get_object(Bucket=bucket, Key=obj_name,
+                                 Range=byte_range)["Body"].read()
+
+        return CompressedEdfReader(read_range)
+
+    def read_edf_header_object(self, obj_name, local=False):
+        """Parse the headers of an edf object without downloading it. The
+        first ranged GET fetches METADATA_HEADER_PREFETCH_KB, which usually
+        holds the main and signal headers, the rest of the signal headers and
+        the first annotations of EDF+ files are fetched separately when they
+        don't fit. Compressed containers are read from their frames. Returns
+        the same dictionary as parse_edf_header and the size of the object."""
+
+        if obj_name.endswith(".zst"):
+            reader = self.open_compressed_edf(obj_name, local=local)
+            header = reader.read_header()
+            layout = self.parse_edf_record_layout(header)
+            if any(label in EDF_ANNOTATION_LABELS
+                   for label in layout["labels"]):
+                header += reader.read_records(0, 1)
+            size = reader.index["uncompressed_size"]
+            return {**self.parse_edf_header(header, file_size=size),
+                    "size": size}
+
+        s3 = self.get_s3_client(local=local)
+        bucket = self.__OBJ_STORAGE_BUCKET_LOCAL__ if local \
+            else self.__OBJ_STORAGE_BUCKET__
+
+        def read_range(start, end):
+            return s3.get_object(Bucket=bucket, Key=obj_name,
+                                 Range=f"bytes={start}-{end - 1}")
+
+        prefetch = max(self.get_config_value("METADATA_HEADER_PREFETCH_KB",
+                                             64, int) * 1024,
+                       EDF_MAIN_HEADER_SIZE)
+        response = read_range(0, prefetch)
+        size = int(response["ContentRange"].rsplit("/", 1)[-1])
+        buffer = response["Body"].read()
+
+        num_signals = int(buffer[EDF_NUM_SIGNALS_FIELD[0]:
+                                 EDF_MAIN_HEADER_SIZE].strip())
+        header_bytes = EDF_MAIN_HEADER_SIZE * (num_signals + 1)
+        if len(buffer) < min(header_bytes, size):
+            buffer += read_range(len(buffer), header_bytes)["Body"].read()
+        layout = self.parse_edf_record_layout(buffer[:header_bytes])
+
+        # Only the annotation signal of the first data record is needed, for
+        # the subsecond start time, it is placed at its offset in the record
+        record_end = header_bytes + layout["record_size"]
+        annotations = [i for i, label in enumerate(layout["labels"])
+                       if label in EDF_ANNOTATION_LABELS]
+        if annotations and len(buffer) < record_end <= size:
+            start = header_bytes + layout["signal_offsets"][annotations[0]]
+            end = start + layout["samples_per_record"][annotations[0]] * \
+                layout["bytes_per_sample"]
+            record = bytearray(record_end)
+            record[:header_bytes] = buffer[:header_bytes]
+            if end > len(buffer):
+                record[start:end] = read_range(start, end)["Body"].read()
+            else:
+                record[start:end] = buffer[start:end]
+            buffer = record
 
-        # Write new file with the same content and anonymized header
-        pyedflib.highlevel.write_edf(new_file_name, signals, signal_headers,
-                                     header)
+        return {**self.parse_edf_header(buffer, file_size=size),
+                "size": size}
 
     def extract_metadata(self, signal_headers, list_of_fields):
         """For each signal (channel) within edf file extract the metadata needed
@@ -136,6 +2210,165 @@ class GenericPlugin(EmptyPlugin):
 
         return signals_metadata
 
+    def extract_metadata_from_object(self, obj_name, list_of_fields=None,
+                                     local=False):
+        """Metadata of an edf object from its headers only, fetched with
+        ranged GETs. The table is the one of extract_metadata with the start
+        datetime and the duration of the file, as they are inserted into
+        Trino."""
+
+        edf_info = self.read_edf_header_object(obj_name, local=local)
+        data = self.extract_metadata(edf_info['SignalHeaders'],
+                                     list_of_fields or METADATA_SIGNAL_FIELDS)
+        data.insert(0, "file_duration", edf_info['Duration'])
+        data.insert(0, "startdate_time", edf_info['startdate'])
+        return data
+
+    def sweep_edf_metadata(self, prefix="EEGs/edf/", list_of_fields=None,
+                           local=False, workers=None):
+        """Metadata of all the edf objects under the prefix, extracted from
+        their headers by a pool of METADATA_SWEEP_WORKERS threads. Returns one
+        table with the object key in the source column, and the keys that
+        could not be read with their errors."""
+
+        import concurrent.futures
+        import time
+
+        import pandas as pd
+
+        s3 = self.get_s3_client(local=local)
+        bucket = self.__OBJ_STORAGE_BUCKET_LOCAL__ if local \
+            else self.__OBJ_STORAGE_BUCKET__
+        workers = workers or self.get_config_value(
+            "METADATA_SWEEP_WORKERS", 20, int)
+
+        def extract(key):
+            try:
+                data = self.extract_metadata_from_object(key, list_of_fields,
+                                                         local=local)
+            except Exception as e:
+                return key, None, e
+            data.insert(0, "source", key)
+            return key, data, None
+
+        started = time.perf_counter()
+        tables = []
+        failures = []
+        keys = (key for key in self.list_object_keys(s3, bucket, prefix)
+                if key.lower().endswith(EDF_OBJECT_SUFFIXES))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) \
+                as executor:
+            for key, data, error in executor.map(extract, keys):
+                if error is not None:
+                    print(f"Metadata of {key} can't be extracted: {error}")
+                    failures.append({"key": key, "error": str(error)})
+                else:
+                    tables.append(data)
+                done = len(tables) + len(failures)
+                if done % 1000 == 0:
+                    print(f"Metadata sweep of {prefix}: {done} files")
+
+        elapsed = time.perf_counter() - started
+        done = len(tables) + len(failures)
+        rate = done / elapsed if elapsed > 0 else 0.0
+        print(f"Metadata sweep of {prefix}: {done} files, {len(failures)} "
+              f"failed, in {elapsed:.2f} s ({rate:.1f} files/s)")
+
+        data = pd.concat(tables, ignore_index=True) if tables \
+            else pd.DataFrame()
+        return data, failures
+
+    def parse_prefilters(self, prefilters):
+        """Split the "key:value" records of the prefilter fields of all the
+        signals at once. Returns a dictionary with one array of values per key,
+        in order of first appearance, with NaN for the signals without it."""
+
+        import numpy as np
+        import pandas as pd
+
+        records = pd.Series(prefilters, dtype=object).str.split().explode()
+        records = records[records.notna()]
+        valid = records.str.count(":") == 1
+
+        for record in records[~valid]:
+            print(f"Values from: {record.split(':')} can't be extracted.")
+
+        columns = {}
+        if not valid.any():
+            return columns
+
+        parts = records[valid].str.partition(":")
+        signals = parts.index.to_numpy()
+        keys = parts[0].to_numpy()
+        values = parts[2].to_numpy()
+
+        for key in pd.unique(keys):
+            mask = keys == key
+            # Later records of the same key override the earlier ones, as
+            # numpy applies repeated indices in order
+            column = np.full(len(prefilters), np.nan, dtype=object)
+            column[signals[mask]] = values[mask]
+            columns[key] = column
+
+        return columns
+
+    def build_metadata_table(self, signal_headers, list_of_fields,
+                             startdate_time, file_duration, personal_id,
+                             source_name, workspace_id, pseudoMRN,
+                             metadata_file_name):
+        """Build the long format table (source, rowid, variable, value,
+        workspace_id) directly from the signal headers, column by column. It
+        has the same rows as extract_metadata followed by transform_input_data,
+        ordered by rowid and then by variable."""
+
+        import numpy as np
+        import pandas as pd
+
+        num_signals = len(signal_headers)
+
+        # Same columns, in the same order, as the wide table of today's path.
+        # Header fields go through pandas type inference, so their values are
+        # converted to strings exactly as before.
+        columns = {"PID": personal_id,
+                   "startdate_time": startdate_time,
+                   "file_duration": file_duration}
+        for field in list_of_fields:
+            columns[field] = pd.Series(
+                [header.get(field, None) for header in signal_headers]
+                ).to_numpy(dtype=object)
+
+        prefilters = self.parse_prefilters(
+            [header.get('prefilter') for header in signal_headers])
+        for key, values in prefilters.items():
+            if key in columns:
+                present = pd.notna(values)
+                values = np.where(present, values, columns[key])
+            columns[key] = values
+
+        columns["pseudoMRN"] = pseudoMRN
+        if metadata_file_name is not None:
+            columns["metadata_file_name"] = metadata_file_name
+
+        # One row per variable, transposed so that rows are ordered by rowid
+        variables = list(columns)
+        values = np.empty((len(variables), num_signals), dtype=object)
+        for index, column in enumerate(columns.values()):
+            values[index, :] = column
+
+        data = pd.DataFrame({
+            "source": source_name,
+            "rowid": np.repeat(np.arange(1, num_signals + 1), len(variables)),
+            "variable": np.tile(np.array(variables, dtype=object),
+                                num_signals),
+            "value": values.T.ravel()})
+
+        # As a variable values type string is expected
+        data = data.astype({"value": "str"})
+
+        data.insert(4, "workspace_id", workspace_id)
+
+        return data
+
     def generate_personal_id(self, personal_data):
         """Based on the identity, full_name and date of birth."""
 
@@ -152,75 +2385,103 @@ class GenericPlugin(EmptyPlugin):
 
     def upload_file(self, path_to_anonymized_file: str,
                      metadata_file_name, metadata_content) -> None:
-        import boto3
-        from botocore.client import Config
         import os
-        from io import BytesIO
+        import time
 
-        s3 = boto3.resource('s3',
-                            endpoint_url=self.__OBJ_STORAGE_URL__,
-                            aws_access_key_id=self.__OBJ_STORAGE_ACCESS_ID__,
-                            aws_secret_access_key=\
-                                self.__OBJ_STORAGE_ACCESS_SECRET__,
-                            config=Config(signature_version='s3v4'),
-                            region_name=self.__OBJ_STORAGE_REGION__)
+        s3 = self.get_s3_client(local=False)
+        transfer_config = self.get_transfer_config(local=False)
+        checksum_args = self.get_checksum_args(local=False)
 
         if os.path.isfile(path_to_anonymized_file):
-            s3.Bucket(self.__OBJ_STORAGE_BUCKET__).\
-                upload_file(path_to_anonymized_file,
-                            "EEGs/edf/" + os.path.basename(path_to_anonymized_file))
-            if metadata_file_name is not None:
-                obj_name = f"metadata_files/{metadata_file_name}"
-                s3.Bucket(self.__OBJ_STORAGE_BUCKET__).upload_fileobj(
-                    BytesIO(metadata_content), obj_name,
-                    ExtraArgs={'ContentType': "text/json"})
+            started = time.perf_counter()
+            obj_name = "EEGs/edf/" + os.path.basename(path_to_anonymized_file)
+            s3.upload_file(path_to_anonymized_file,
+                           self.__OBJ_STORAGE_BUCKET__, obj_name,
+                           ExtraArgs=checksum_args or None,
+                           Config=transfer_config)
+            self.log_transfer("Uploaded", obj_name,
+                              os.path.getsize(path_to_anonymized_file),
+                              started)
+            self.upload_metadata_file(metadata_file_name, metadata_content)
+
+    def upload_metadata_file(self, metadata_file_name, metadata_content):
+        from io import BytesIO
+
+        if metadata_file_name is not None:
+            obj_name = f"metadata_files/{metadata_file_name}"
+            self.get_s3_client(local=False).upload_fileobj(
+                BytesIO(metadata_content), self.__OBJ_STORAGE_BUCKET__,
+                obj_name,
+                ExtraArgs={'ContentType': "text/json",
+                           **self.get_checksum_args(local=False)},
+                Config=self.get_transfer_config(local=False))
+
+    def get_pid_mapping_store(self):
+        """Filename to pid mapping store in the local object storage"""
+
+        return FilenamePidMappingStore(
+            self.get_s3_client(local=True), self.__OBJ_STORAGE_BUCKET_LOCAL__,
+            compact_segments=self.get_config_value(
+                "PID_MAPPING_COMPACT_SEGMENTS", 100, int))
 
     def update_filename_pid_mapping(self, obj_name, personal_id, pseudoMRN, mrn):
-        import boto3
-        from botocore.client import Config
-        import csv
-        import io
+        """Append the mapping between the file and the patient as a new
+        segment, segments are compacted once there are enough of them"""
 
-        s3_local = boto3.resource('s3',
-                                  endpoint_url=self.__OBJ_STORAGE_URL_LOCAL__,
-                                  aws_access_key_id=\
-                                    self.__OBJ_STORAGE_ACCESS_ID_LOCAL__,
-                                  aws_secret_access_key=\
-                                    self.__OBJ_STORAGE_ACCESS_SECRET_LOCAL__,
-                                  config=Config(signature_version='s3v4'),
-                                  region_name=self.__OBJ_STORAGE_REGION__)
-        folder = "file_pid/"
-        filename = "filename_pid.csv"
-        file_path = f"{folder}{filename}"
         obj_name_path = f"EEGs/edf/{obj_name}"
 
-        bucket_local = s3_local.Bucket(self.__OBJ_STORAGE_BUCKET_LOCAL__)
-        obj_files = bucket_local.objects.filter(Prefix=folder, Delimiter="/")
-
-        if (len(list(obj_files))) > 0:
-            existing_object = s3_local.Object(self.__OBJ_STORAGE_BUCKET_LOCAL__,
-                                              file_path)
-            existing_data = existing_object.get()["Body"].read().decode('utf-8')
-            data_to_append = [obj_name_path, personal_id, pseudoMRN, mrn]
-            existing_rows = list(csv.reader(io.StringIO(existing_data)))
-            existing_rows.append(data_to_append)
-
-            # Update column names
-            column_names = ['filename', 'personal_id', 'pseudoMRN', 'MRN']
-            if any(col_name not in existing_rows[0] for col_name in column_names):
-                existing_rows[0] = column_names
-
-            updated_data = io.StringIO()
-            csv.writer(updated_data).writerows(existing_rows)
-            s3_local.Bucket(self.__OBJ_STORAGE_BUCKET_LOCAL__).upload_fileobj(
-                io.BytesIO(updated_data.getvalue().encode('utf-8')), file_path)
-        else:
-            key_values = ['filename', 'personal_id', 'pseudoMRN', 'MRN']
-            file_data = [key_values, [obj_name_path, personal_id, pseudoMRN, mrn]]
-            updated_data = io.StringIO()
-            csv.writer(updated_data).writerows(file_data)
-            s3_local.Bucket(self.__OBJ_STORAGE_BUCKET_LOCAL__).upload_fileobj(
-                io.BytesIO(updated_data.getvalue().encode('utf-8')), file_path)
+        store = self.get_pid_mapping_store()
+        store.append([[obj_name_path, personal_id, pseudoMRN, mrn]])
+        store.maybe_compact()
+
+    def lookup_filename_pid_mapping(self, column, value):
+        """Rows of the filename to pid mapping by filename, personal_id or
+        pseudoMRN"""
+
+        return self.get_pid_mapping_store().lookup(column, value)
+
+    def get_processing_ledger(self):
+        """Processing ledger configured with LEDGER_BACKEND, either sqlite or
+        s3, or None when reruns should process files from scratch"""
+
+        backend = self.get_config_value("LEDGER_BACKEND")
+        if backend is None:
+            return None
+        if backend.lower() == "sqlite":
+            return SQLiteProcessingLedger(self.get_config_value(
+                "LEDGER_SQLITE_PATH",
+                "mescobrad_edge/plugins/edf_anonymisation_plugin/"
+                "ledger.sqlite"))
+        if backend.lower() == "s3":
+            return S3ProcessingLedger(
+                self.get_s3_client(local=True),
+                self.__OBJ_STORAGE_BUCKET_LOCAL__,
+                folder=self.get_config_value("LEDGER_S3_FOLDER", "ledger/"))
+        raise ValueError(f"Unknown ledger backend {backend}.")
+
+    def get_ledger_key(self, data_info, source_name):
+        """Key of the file in the processing ledger. It is derived from the
+        SHA-256 checksum, or else the ETag, of the uploaded object, and from
+        the workspace and name under which the file is stored, so the same
+        upload processed again gets the same key. None is returned when the
+        object doesn't exist."""
+
+        import hashlib
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self.get_s3_client(local=True).head_object(
+                Bucket=self.__OBJ_STORAGE_BUCKET_LOCAL__,
+                Key=data_info['filename'], ChecksumMode="ENABLED")
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+        content_id = head.get("ChecksumSHA256") or head["ETag"].strip('"')
+        identity = "\0".join([content_id, str(data_info.get("workspace_id")),
+                              source_name])
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
 
     def calculate_pseudoMRN(self, mrn, workspace_id):
         import hashlib
@@ -237,198 +2498,833 @@ class GenericPlugin(EmptyPlugin):
         return pseudoMRN
 
     def remove_tmp_edf_files(self, file_path):
-        import boto3
-        from botocore.client import Config
-
-        s3_local = boto3.resource('s3',
-                                  endpoint_url=self.__OBJ_STORAGE_URL_LOCAL__,
-                                  aws_access_key_id=\
-                                    self.__OBJ_STORAGE_ACCESS_ID_LOCAL__,
-                                  aws_secret_access_key=\
-                                    self.__OBJ_STORAGE_ACCESS_SECRET_LOCAL__,
-                                  config=Config(signature_version='s3v4'),
-                                  region_name=self.__OBJ_STORAGE_REGION__)
+        s3_local = self.get_s3_client(local=True)
+        bucket_local = self.__OBJ_STORAGE_BUCKET_LOCAL__
 
         # Remove the file from the tmp folder if the file is not processed
-        # successfully
-        objs = list(s3_local.Bucket(self.__OBJ_STORAGE_BUCKET_LOCAL__).\
-                    objects.filter(Prefix="edf_data_tmp/", Delimiter="/"))
-        if len(list(objs))>0:
-            for obj in objs:
-                if obj.key in file_path:
-                    s3_local.Bucket(self.__OBJ_STORAGE_BUCKET_LOCAL__
-                                    ).objects.filter(Prefix=file_path).delete()
+        # successfully, listing only the keys under its own name
+        if not file_path.startswith("edf_data_tmp/"):
+            return
+        for key in self.list_object_keys(s3_local, bucket_local, file_path):
+            s3_local.delete_object(Bucket=bucket_local, Key=key)
 
-    def action(self, input_meta: PluginExchangeMetadata = None) -> \
-          PluginActionResponse:
-        """
-        Run the anonymisation process of the edf files.
-        Extract metadata from the edf files.
-        Upload anonymized files to the corresponding storage.
-        """
-        import os
-        import pandas as pd
+    def get_trino_connection(self, transactional=False):
+        """Initialize the connection with Trino, in autocommit mode unless
+        transactional is set"""
 
         from trino.dbapi import connect
         from trino.auth import BasicAuthentication
+        from trino.transaction import IsolationLevel
+
+        return connect(
+            host=self.__TRINO_HOST__,
+            port=self.__TRINO_PORT__,
+            http_scheme="https",
+            auth=BasicAuthentication(self.__TRINO_USER__,
+                                     self.__TRINO_PASSWORD__),
+            isolation_level=IsolationLevel.READ_COMMITTED if transactional
+            else IsolationLevel.AUTOCOMMIT
+        )
+
+    def get_metadata_sink(self):
+        """Write-behind sink of the metadata rows of the configured table,
+        shared within the process, or None when METADATA_SINK is disabled and
+        rows are inserted file by file"""
+
+        import os
+
+        if not self.get_config_value("METADATA_SINK", True, bool):
+            return None
+
+        schema_name = self.__OBJ_STORAGE_BUCKET__.replace("-", "_")
+        table_name = self.__OBJ_STORAGE_TABLE__.replace("-", "_")
+        spool_dir = self.get_config_value(
+            "METADATA_SINK_SPOOL_DIR",
+            "mescobrad_edge/plugins/edf_anonymisation_plugin/metadata_spool/")
+        spool_prefix = os.path.abspath(
+            os.path.join(spool_dir, f"{schema_name}.{table_name}"))
+
+        with _METADATA_SINKS_LOCK:
+            sink = _METADATA_SINKS.get(spool_prefix)
+            if sink is None:
+                sink = TrinoMetadataSink(
+                    self, schema_name, table_name, spool_prefix,
+                    max_rows=self.get_config_value("METADATA_SINK_MAX_ROWS",
+                                                   5000, int),
+                    max_seconds=self.get_config_value(
+                        "METADATA_SINK_MAX_SECONDS", 60.0, float),
+                    chunk_rows=self.get_config_value(
+                        "METADATA_SINK_CHUNK_ROWS", 5000, int),
+                    transaction=self.get_config_value(
+                        "METADATA_SINK_TRANSACTION", False, bool))
+                _METADATA_SINKS[spool_prefix] = sink
+        return sink
+
+    def get_spool_dir(self):
+        """Directory where files are staged, e.g. on tmpfs or a local NVMe
+        drive, with a trailing separator"""
+
+        import os
+
+        spool_dir = self.get_config_value(
+            "SPOOL_DIR",
+            "mescobrad_edge/plugins/edf_anonymisation_plugin/anonymize_files/")
+        return os.path.join(spool_dir, "")
+
+    def get_admission_controller(self):
+        """Admission controller of the spool directory, shared within the
+        process. Budgets not configured default to 90% of the free space of
+        the spool directory and half of the available memory, memory is not
+        budgeted when it can't be read."""
 
+        import os
+        import shutil
+
+        spool_dir = os.path.abspath(self.get_spool_dir())
+        megabyte = 1024 * 1024
+
+        with _ADMISSION_CONTROLLERS_LOCK:
+            controller = _ADMISSION_CONTROLLERS.get(spool_dir)
+            if controller is None:
+                os.makedirs(spool_dir, exist_ok=True)
+                disk_budget = self.get_config_value(
+                    "ADMISSION_DISK_BUDGET_MB", None, float)
+                disk_budget = int(disk_budget * megabyte) \
+                    if disk_budget is not None \
+                    else int(shutil.disk_usage(spool_dir).free * 0.9)
+                memory_budget = self.get_config_value(
+                    "ADMISSION_MEMORY_BUDGET_MB", None, float)
+                if memory_budget is not None:
+                    memory_budget = int(memory_budget * megabyte)
+                else:
+                    available = self.available_memory_bytes()
+                    memory_budget = available // 2 \
+                        if available is not None else None
+                controller = AdmissionController(
+                    spool_dir, disk_budget, memory_budget,
+                    poll_seconds=self.get_config_value(
+                        "ADMISSION_POLL_SECONDS", 0.5, float))
+                _ADMISSION_CONTROLLERS[spool_dir] = controller
+        return controller
+
+    def available_memory_bytes(self):
+        """Memory available to new processes, None if it can't be read"""
+
+        import os
+
+        try:
+            with open("/proc/meminfo") as meminfo:
+                for line in meminfo:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
         try:
-            # Initialize the connection with Trino
-            conn = connect(
-                host=self.__TRINO_HOST__,
-                port=self.__TRINO_PORT__,
-                http_scheme="https",
-                auth=BasicAuthentication(self.__TRINO_USER__,
-                                        self.__TRINO_PASSWORD__)
-            )
-
-            # Get the schema name, schema in Trino is an equivalent to a bucket
-            # in MinIO Trino doesn't allow to have "-" in schema name so it
-            # needs to be replaced with "_"
-            schema_name = self.__OBJ_STORAGE_BUCKET__.replace("-", "_")
-
-            # Get the table name
-            table_name = self.__OBJ_STORAGE_TABLE__.replace("-", "_")
-
-            path_to_data = \
-                "mescobrad_edge/plugins/edf_anonymisation_plugin/anonymize_files/"
-
-            path_to_anonymized_data = f"{path_to_data}anonymized/"
-
-            # create temporary folder for storing downloaded files
-            os.makedirs(path_to_data, exist_ok=True)
-            os.makedirs(path_to_anonymized_data, exist_ok=True)
-
-            # Generate pseudoMRN
-            pseudoMRN = self.calculate_pseudoMRN(
-                input_meta.data_info['MRN'],
-                input_meta.data_info['workspace_id'])
-
-            basename = os.path.basename(input_meta.data_info['filename'])
-
-            if pseudoMRN is not None:
-                path_to_download_file = f"{path_to_data}{pseudoMRN}_{basename}"
-                path_to_anonymized_file = \
-                    f"{path_to_anonymized_data}{pseudoMRN}_{basename}"
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            return None
+
+    def estimate_job_footprint(self, job):
+        """Disk and memory the processing of the file is estimated to use,
+        from the size of the object and the record layout of its header,
+        both fetched with a ranged GET"""
+
+        edf_info = self.read_edf_header_object(job["data_info"]['filename'],
+                                               local=True)
+        size = edf_info["size"]
+        layout = edf_info["layout"]
+
+        megabyte = 1024 * 1024
+        memory = self.get_config_value("ADMISSION_JOB_BASE_MEMORY_MB", 64,
+                                       float) * megabyte
+        if job["diskless"]:
+            # Parts in flight, fetched when annotations are scrubbed
+            transfer_config = self.get_transfer_config(local=False)
+            disk = 0
+            memory += 2 * transfer_config.multipart_chunksize * \
+                transfer_config.max_concurrency
+        else:
+            # Downloaded and anonymized copies, chunks of the download and
+            # the batch of records streamed through the record transform
+            transfer_config = self.get_transfer_config(local=True)
+            disk = 2 * size
+            memory += transfer_config.multipart_chunksize * \
+                transfer_config.max_concurrency
+            memory += self.get_config_value(
+                "EDF_STREAM_BATCH_RECORDS", DEFAULT_STREAM_BATCH_RECORDS,
+                int) * layout["record_size"]
+            if job["path_to_compressed_file"] is not None:
+                # Container, and frames read ahead and compressed per thread
+                disk += size
+                memory += 4 * self.get_config_value(
+                    "COMPRESSION_THREADS", 1, int) * self.get_config_value(
+                        "COMPRESSION_FRAME_SIZE_MB", 4.0, float) * megabyte
+
+        return {"disk_bytes": int(disk), "memory_bytes": int(memory),
+                "object_bytes": size}
+
+    def admit_file_stage(self, job):
+        """Wait until the footprint of the file fits in the admission
+        budgets, the reservation is released by the cleanup"""
+
+        if not self.get_config_value("ADMISSION_CONTROL", True, bool):
+            return
+
+        with job["metrics"].stage("admission") as stage:
+            footprint = self.estimate_job_footprint(job)
+            controller = self.get_admission_controller()
+            reservation_id, waited, queue_depth = controller.acquire(
+                job["data_info"]['filename'], footprint["disk_bytes"],
+                footprint["memory_bytes"])
+            job["admission"] = {"controller": controller,
+                                "reservation_id": reservation_id,
+                                "wait_seconds": waited,
+                                "queue_depth": queue_depth, **footprint}
+            stage["bytes"] = footprint["disk_bytes"]
+        if waited >= 1:
+            print(f"File {job['data_info']['filename']} waited "
+                  f"{waited:.1f} s for admission, {queue_depth} files "
+                  f"queued.")
+
+    def get_local_file_paths(self, data_info, pseudoMRN):
+        """Paths of the downloaded and of the anonymized copy of the file"""
+
+        import os
+
+        path_to_data = self.get_spool_dir()
+
+        path_to_anonymized_data = f"{path_to_data}anonymized/"
+
+        # create temporary folder for storing downloaded files
+        os.makedirs(path_to_data, exist_ok=True)
+        os.makedirs(path_to_anonymized_data, exist_ok=True)
+
+        basename = os.path.basename(data_info['filename'])
+
+        if pseudoMRN is not None:
+            path_to_download_file = f"{path_to_data}{pseudoMRN}_{basename}"
+            path_to_anonymized_file = \
+                f"{path_to_anonymized_data}{pseudoMRN}_{basename}"
+        else:
+            path_to_download_file = f"{path_to_data}{basename}"
+            path_to_anonymized_file = f"{path_to_anonymized_data}{basename}"
+
+        return path_to_download_file, path_to_anonymized_file
+
+    def prepare_file_job(self, data_info, metrics=None):
+        """State of the processing of one edf file, passed from stage to
+        stage: names and local paths of the file, the metrics of its stages
+        and the stages already completed according to the processing ledger"""
+
+        import os
+
+        data_info = dict(data_info)
+
+        if metrics is None:
+            metrics = self.create_pipeline_metrics(data_info['filename'])
+
+        # Generate pseudoMRN
+        pseudoMRN = self.calculate_pseudoMRN(data_info.get('MRN'),
+                                             data_info.get('workspace_id'))
+
+        path_to_download_file, path_to_anonymized_file = \
+            self.get_local_file_paths(data_info, pseudoMRN)
+
+        # Source name of the original edf file
+        source_name = os.path.basename(path_to_download_file)
+
+        # Stages completed by previous runs on the same upload of the file
+        ledger = self.get_processing_ledger()
+        ledger_key = None
+        if ledger is not None:
+            ledger_key = self.get_ledger_key(data_info, source_name)
+        completed = ledger.get(ledger_key) if ledger_key is not None else {}
+
+        # Compressed containers are written from the local anonymized file,
+        # so compression turns the diskless mode off
+        compressed = self.get_config_value("COMPRESSED_OUTPUT", False, bool)
+        diskless = self.get_config_value("DISKLESS_ANONYMIZATION", False,
+                                         bool) and not compressed
+
+        return {"data_info": data_info,
+                "metrics": metrics,
+                "pseudoMRN": pseudoMRN,
+                "path_to_download_file": path_to_download_file,
+                "path_to_anonymized_file": path_to_anonymized_file,
+                "path_to_compressed_file": f"{path_to_anonymized_file}.zst"
+                if compressed else None,
+                "source_name": source_name,
+                "diskless": diskless,
+                "ledger": ledger,
+                "ledger_key": ledger_key,
+                "completed": completed,
+                "already_processed": all(completed.get(stage) == "done"
+                                         for stage in LEDGER_STAGES),
+                "edf_info": None,
+                "admission": None}
+
+    def mark_ledger_stage(self, job, stage, status):
+        if job["ledger_key"] is not None:
+            job["ledger"].mark(job["ledger_key"], stage, status,
+                               job["data_info"]['filename'])
+
+    def fetch_file_stage(self, job):
+        """Wait for the admission of the file, then download it and read the
+        headers of the original file, signals are not decoded. Nothing is
+        fetched in diskless mode, the headers are read by the
+        anonymisation."""
+
+        import os
+
+        if job["already_processed"]:
+            return
+
+        self.admit_file_stage(job)
+
+        if job["diskless"]:
+            return
+
+        data_info = job["data_info"]
+        metrics = job["metrics"]
+        path_to_download_file = job["path_to_download_file"]
+
+        # Download data to process
+        with metrics.stage("download") as stage:
+            self.download_file(path_to_download_file, data_info['filename'])
+
+            if not os.path.isfile(path_to_download_file):
+                raise FileNotFoundError(
+                    f"File {data_info['filename']} was not downloaded.")
+            stage["bytes"] = os.path.getsize(path_to_download_file)
+
+        print("Processing started ...")
+        with metrics.stage("read_edf") as stage:
+            job["edf_info"] = self.read_edf_header_mmap(path_to_download_file)
+            stage["bytes"] = job["edf_info"]['layout']['header_bytes']
+
+    def anonymise_file_stage(self, job, executor=None):
+        """Remove personal information from the headers. The anonymisation
+        runs on the executor if one is given."""
+
+        import os
+
+        if job["already_processed"]:
+            return
+
+        data_info = job["data_info"]
+        path_to_download_file = job["path_to_download_file"]
+        path_to_anonymized_file = job["path_to_anonymized_file"]
+
+        # Remove personal information from headers
+        remove_values = ["patientname", "birthdate",
+                         "patient_additional", "patientcode",
+                         "admincode", "gender", "sex", "technician"]
+
+        # Set empty values
+        new_values = ["", "", "", "", "", "", "", ""]
+
+        # Identifiers of the patient in the texts of the annotations
+        scrubber = self.get_annotation_scrubber(data_info)
+
+        print("Anonymization started ... ")
+        with job["metrics"].stage("anonymise") as stage:
+            if job["diskless"]:
+                # Only the headers are fetched, the data records are copied
+                # within the object storage unless annotations are scrubbed
+                job["edf_info"] = self.anonymize_file_diskless(
+                    data_info['filename'],
+                    os.path.basename(path_to_download_file),
+                    os.path.basename(path_to_anonymized_file),
+                    remove_values, new_values, scrubber)
+                layout = job["edf_info"]['layout']
+                stage["bytes"] = layout["header_bytes"] + \
+                    max(layout["num_records"], 0) * layout["record_size"]
             else:
-                path_to_download_file = f"{path_to_data}{basename}"
-                path_to_anonymized_file = f"{path_to_anonymized_data}{basename}"
-
-            # Download data to process
-            self.download_file(path_to_download_file,
-                               input_meta.data_info['filename'])
-
-            # Anonymize files
-            if os.path.isfile(path_to_download_file):
-                # Read the file and get all the data from the original file
-                print("Processing started ...")
-                signals, signal_headers, header = \
-                    pyedflib.highlevel.read_edf(path_to_download_file)
-
-                # Remove personal information from headers
-                remove_values = ["patientname", "birthdate",
-                                 "patient_additional", "patientcode",
-                                 "admincode", "gender", "sex", "technician"]
-
-                # Set empty values
-                new_values = ["", "", "", "", "", "", "", ""]
-
-                print("Anonymization started ... ")
-                self.anonymize_edf_file(signals, signal_headers, header,
-                                        path_to_anonymized_file,
-                                        remove_values, new_values)
-
-                # Extract metadata information from the edf file, from signal
-                # header
-                list_of_fields_to_extract = ['label','sample_rate',
-                                             'sample_frequency', 'prefilter',
-                                             'dimension']
-
-                print("Extracting metadata information ... ")
-                data = self.extract_metadata(signal_headers,
-                                             list_of_fields_to_extract)
-
-                # Extract additional information from header (startdate/time and
-                # duration of the signal)
-                f = pyedflib.EdfReader(path_to_download_file)
-                file_duration = f.getFileDuration()
-                startdate_time = f.getStartdatetime()
-                del f
-
-                # Insert additional data in extracted metadata from signal
-                # headers
-                data.insert(0, 'file_duration', file_duration)
-                data.insert(0, 'startdate_time', startdate_time)
-
-                # Source name of the original edf file
-                source_name = os.path.basename(path_to_download_file)
-
-                # Metadata file name
-                metadata_file_template = "{name}.json"
-                if input_meta.data_info["metadata_json_file"] is not None:
-                    metadata_file_name = metadata_file_template.format(
-                        name=os.path.splitext(source_name)[0])
+                # Data records are only streamed when there are annotations
+                # to scrub, otherwise they are copied as they are
+                record_transform = None
+                if scrubber and scrubber.annotation_signals(
+                        job["edf_info"]['layout']):
+                    record_transform = scrubber
+
+                if executor is not None:
+                    executor.submit(self.anonymize_edf_header,
+                                    path_to_download_file,
+                                    path_to_anonymized_file,
+                                    remove_values, new_values,
+                                    record_transform).result()
                 else:
-                    metadata_file_name = None
-
-                # Generate personal id
-                data_info = input_meta.data_info
-                if all(param is not None for param in [data_info['name'],
-                                                       data_info['surname'],
-                                                       data_info['date_of_birth'],
-                                                       data_info['unique_id']]):
-
-                    # Make unified dates, so that different formats of date
-                    # doesn't change the final id
-                    data_info["date_of_birth"] = pd.to_datetime(
-                        data_info["date_of_birth"], dayfirst=True)
-
-                    data_info["date_of_birth"] = \
-                        data_info["date_of_birth"].strftime("%d-%m-%Y")
-
-                    # ID is generated based on name, surname, date of birth,
-                    # national unique ID
-                    personal_data = [data_info['name'], data_info['surname'],
-                                     data_info['date_of_birth'],
-                                     data_info['unique_id']]
-                    personal_id = self.generate_personal_id(personal_data)
+                    self.anonymize_edf_header(path_to_download_file,
+                                              path_to_anonymized_file,
+                                              remove_values, new_values,
+                                              record_transform)
+                stage["bytes"] = os.path.getsize(path_to_anonymized_file)
+
+        path_to_compressed_file = job["path_to_compressed_file"]
+        if path_to_compressed_file is not None:
+            with job["metrics"].stage("compress") as stage:
+                if executor is not None:
+                    executor.submit(self.compress_edf_file,
+                                    path_to_anonymized_file,
+                                    path_to_compressed_file).result()
                 else:
-                    personal_id = None
-
-                # Insert personal id in the extracted data
-                data.insert(0, "PID", personal_id)
+                    self.compress_edf_file(path_to_anonymized_file,
+                                           path_to_compressed_file)
+                stage["bytes"] = os.path.getsize(path_to_anonymized_file)
+                ratio = stage["bytes"] / \
+                    max(os.path.getsize(path_to_compressed_file), 1)
+                print(f"Compressed {os.path.basename(path_to_anonymized_file)}"
+                      f" {ratio:.2f}x")
+
+    def publish_file_stage(self, job, conn=None):
+        """Extract the metadata, insert it into Trino, or hand it to the
+        metadata sink, update the filename to pid mapping and upload the
+        anonymized file. Stages recorded as done in the processing ledger are
+        skipped. A Trino connection is opened if one is needed and conn is not
+        given."""
 
-                # Transform data in suitable form for updating trino table
-                data_transformed = self.transform_input_data(
-                    data, source_name, input_meta.data_info["workspace_id"],
-                    pseudoMRN, metadata_file_name)
-
-                self.upload_data_on_trino(schema_name, table_name,
-                                          data_transformed, conn)
+        import os
+        import pandas as pd
 
-                # Update key value file with mapping between filename and
-                # patient id, this file is stored in the local MinIO
-                # instance
+        if job["already_processed"]:
+            return
+
+        data_info = job["data_info"]
+        metrics = job["metrics"]
+        completed = job["completed"]
+        source_name = job["source_name"]
+        pseudoMRN = job["pseudoMRN"]
+        path_to_anonymized_file = job["path_to_anonymized_file"]
+
+        # Get the schema name, schema in Trino is an equivalent to a bucket
+        # in MinIO Trino doesn't allow to have "-" in schema name so it
+        # needs to be replaced with "_"
+        schema_name = self.__OBJ_STORAGE_BUCKET__.replace("-", "_")
+
+        # Get the table name
+        table_name = self.__OBJ_STORAGE_TABLE__.replace("-", "_")
+
+        # Extract additional information from header (startdate/time and
+        # duration of the signal)
+        file_duration = job["edf_info"]['Duration']
+        startdate_time = job["edf_info"]['startdate']
+
+        # Metadata file name
+        metadata_file_template = "{name}.json"
+        if data_info.get("metadata_json_file") is not None:
+            metadata_file_name = metadata_file_template.format(
+                name=os.path.splitext(source_name)[0])
+        else:
+            metadata_file_name = None
+
+        print("Extracting metadata information ... ")
+        with metrics.stage("metadata") as stage:
+            # Generate personal id
+            if all(data_info.get(param) is not None for param in
+                   ['name', 'surname', 'date_of_birth', 'unique_id']):
+
+                # Make unified dates, so that different formats of date
+                # doesn't change the final id
+                data_info["date_of_birth"] = pd.to_datetime(
+                    data_info["date_of_birth"], dayfirst=True)
+
+                data_info["date_of_birth"] = \
+                    data_info["date_of_birth"].strftime("%d-%m-%Y")
+
+                # ID is generated based on name, surname, date of birth,
+                # national unique ID
+                personal_data = [data_info['name'], data_info['surname'],
+                                 data_info['date_of_birth'],
+                                 data_info['unique_id']]
+                personal_id = self.generate_personal_id(personal_data)
+            else:
+                personal_id = None
+
+            # Extract metadata information from the edf file, from signal
+            # header, directly in the form suitable for updating trino
+            # table
+            data_transformed = self.build_metadata_table(
+                job["edf_info"]['SignalHeaders'], METADATA_SIGNAL_FIELDS,
+                startdate_time, file_duration, personal_id, source_name,
+                data_info.get("workspace_id"), pseudoMRN, metadata_file_name)
+            stage["rows"] = len(data_transformed)
+
+        with metrics.stage("trino_insert") as stage:
+            if completed.get("trino_insert") == "done":
+                stage["status"] = "skipped"
+            else:
+                # Rows go to the write-behind sink when it is enabled, they
+                # are inserted with the rows of other files
+                sink = self.get_metadata_sink()
+                if conn is None and sink is None:
+                    conn = self.get_trino_connection()
+
+                # Rows of an interrupted insert would be duplicated
+                interrupted = completed.get("trino_insert") == "started"
+                if interrupted and sink is None:
+                    self.delete_data_on_trino(
+                        schema_name, table_name, source_name,
+                        data_info.get("workspace_id"), conn)
+                self.mark_ledger_stage(job, "trino_insert", "started")
+                if sink is not None:
+                    # Rows are spooled to disk, so they are as good as
+                    # inserted. The rows of an interrupted insert are
+                    # deleted by the flush, on the connection of the sink.
+                    stage["rows"] = sink.add(data_transformed,
+                                             replace=interrupted)
+                else:
+                    stage["rows"] = self.upload_data_on_trino(
+                        schema_name, table_name, data_transformed,
+                        conn)["rows"]
+                self.mark_ledger_stage(job, "trino_insert", "done")
+
+        # Update key value file with mapping between filename and
+        # patient id, this file is stored in the local MinIO
+        # instance
+        with metrics.stage("pid_mapping") as stage:
+            if completed.get("pid_mapping") == "done":
+                stage["status"] = "skipped"
+            else:
                 self.update_filename_pid_mapping(source_name, personal_id,
                                                  pseudoMRN,
-                                                 input_meta.data_info['MRN'])
+                                                 data_info.get('MRN'))
+                stage["rows"] = 1
+                self.mark_ledger_stage(job, "pid_mapping", "done")
+
+        # Upload processed data
+        print("Uploading file ...")
+        with metrics.stage("upload") as stage:
+            metadata_content = data_info.get("metadata_json_file")
+            if job["diskless"]:
+                self.upload_metadata_file(metadata_file_name,
+                                          metadata_content)
+            else:
+                # The compressed container replaces the edf file
+                path_to_upload = job["path_to_compressed_file"] or \
+                    path_to_anonymized_file
+                self.upload_file(path_to_upload, metadata_file_name,
+                                 metadata_content)
+                stage["bytes"] = os.path.getsize(path_to_upload)
+            if metadata_file_name is not None:
+                stage["bytes"] += len(metadata_content)
+            self.mark_ledger_stage(job, "upload", "done")
+        print("Processing of the edf file is finished.")
 
-            # Upload processed data
-            print("Uploading file ...")
-            self.upload_file(path_to_anonymized_file, metadata_file_name,
-                             input_meta.data_info["metadata_json_file"])
-            print("Processing of the edf file is finished.")
+    def cleanup_file_stage(self, job):
+        """Remove the downloaded and anonymized files, and the uploaded file
+        from the tmp folder of the object storage, then release the admission
+        reservation of the file"""
 
-        except Exception as e:
-            print("EDF processing failed with error: " + str(e))
+        import os
+
+        if job["already_processed"]:
+            print(f"File {job['data_info']['filename']} was already "
+                  f"processed.")
 
+        try:
+            with job["metrics"].stage("cleanup"):
+                for path in [job["path_to_download_file"],
+                             job["path_to_anonymized_file"],
+                             job["path_to_compressed_file"]]:
+                    if path is not None and os.path.exists(path):
+                        os.remove(path)
+
+                self.remove_tmp_edf_files(job["data_info"]['filename'])
         finally:
-            # Remove downloaded and anonymized files
-            if os.path.exists(path_to_download_file):
-                os.remove(path_to_download_file)
-            if os.path.exists(path_to_anonymized_file):
-                os.remove(path_to_anonymized_file)
+            if job["admission"] is not None:
+                job["admission"]["controller"].release(
+                    job["admission"]["reservation_id"])
+
+    def process_file(self, data_info, conn=None, executor=None,
+                     metrics=None):
+        """
+        Run the anonymisation process of one edf file, extract its metadata and
+        upload the anonymized file to the corresponding storage. Errors are
+        raised to the caller. The anonymisation runs on the executor if one is
+        given. Each stage is recorded in metrics, a new PipelineMetrics is
+        used if none is given, and the metrics report is returned.
+
+        When a processing ledger is configured, the Trino insert, the pid
+        mapping update and the upload done by previous runs on the same
+        upload of the file are skipped. Local stages always run again, their
+        outputs are removed at the end of each run.
+        """
+
+        job = self.prepare_file_job(data_info, metrics)
+
+        try:
+            self.fetch_file_stage(job)
+            self.anonymise_file_stage(job, executor)
+            self.publish_file_stage(job, conn)
+        finally:
+            self.cleanup_file_stage(job)
+
+        return job["metrics"].report()
+
+    def run_pipeline(self, batch, conn):
+        """
+        Process the files of the batch in a pipeline of stages connected by
+        bounded queues, so that a file is downloaded while the previous one
+        is anonymised and the one before is uploaded. Each stage has its own
+        number of workers, and at most PIPELINE_QUEUE_SIZE files wait between
+        two stages, which bounds the downloaded files kept on disk. The
+        anonymisation runs on a process pool, the other stages on threads.
+        Returns the jobs in the order of the batch, with the error and
+        traceback of the failed ones.
+        """
+
+        import asyncio
+        import os
+        import time
+        import traceback
+        from concurrent.futures import ProcessPoolExecutor, \
+            ThreadPoolExecutor
+
+        cpu_workers = self.get_config_value("BATCH_CPU_WORKERS",
+                                            os.cpu_count() or 1, int)
+        download_workers = self.get_config_value("PIPELINE_DOWNLOAD_WORKERS",
+                                                 4, int)
+        upload_workers = self.get_config_value("PIPELINE_UPLOAD_WORKERS", 4,
+                                               int)
+        queue_size = self.get_config_value("PIPELINE_QUEUE_SIZE", 2, int)
+
+        async def run_stage(position, inbox, outbox):
+            function, args, workers = stages[position]
+            is_cleanup = position == len(stages) - 1
+            loop = asyncio.get_running_loop()
+
+            async def worker():
+                while True:
+                    job = await inbox.get()
+                    if job is None:
+                        break
+                    if job["error"] is None or is_cleanup:
+                        try:
+                            await loop.run_in_executor(thread_pool, function,
+                                                       job, *args)
+                        except Exception as e:
+                            if job["error"] is None:
+                                job["error"] = str(e)
+                                job["traceback"] = traceback.format_exc()
+                    if is_cleanup:
+                        job["elapsed_seconds"] = \
+                            time.perf_counter() - job["started"]
+                    await outbox.put(job)
+
+            await asyncio.gather(*[worker() for _ in range(workers)])
+
+        async def feed(inbox, done):
+            loop = asyncio.get_running_loop()
+            for position, file_info in enumerate(batch):
+                job = {"position": position, "data_info": file_info,
+                       "metrics": self.create_pipeline_metrics(
+                           file_info['filename']),
+                       "started": time.perf_counter(), "error": None}
+                try:
+                    job.update(await loop.run_in_executor(
+                        thread_pool, self.prepare_file_job, file_info,
+                        job["metrics"]))
+                except Exception as e:
+                    job["error"] = str(e)
+                    job["traceback"] = traceback.format_exc()
+                    job["elapsed_seconds"] = \
+                        time.perf_counter() - job["started"]
+                    await done.put(job)
+                    continue
+                # Waits while the first stage is saturated
+                await inbox.put(job)
+
+        async def run():
+            queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+            # Finished jobs are collected at the end
+            done = asyncio.Queue()
+            outboxes = queues[1:] + [done]
+
+            feeding = asyncio.ensure_future(feed(queues[0], done))
+            tasks = [asyncio.ensure_future(run_stage(position, inbox, outbox))
+                     for position, (inbox, outbox) in
+                     enumerate(zip(queues, outboxes))]
+
+            # Each stage is closed once the previous one has finished
+            await feeding
+            for (_, _, workers), inbox, task in zip(stages, queues, tasks):
+                for _ in range(workers):
+                    await inbox.put(None)
+                await task
+
+            jobs = [done.get_nowait() for _ in range(done.qsize())]
+            return sorted(jobs, key=lambda job: job["position"])
+
+        # Stage workers wait on the thread pool, plus the feeder
+        threads = 2 * download_workers + cpu_workers + upload_workers + 1
+        with ProcessPoolExecutor(max_workers=cpu_workers) as cpu_pool, \
+                ThreadPoolExecutor(max_workers=threads) as thread_pool:
+            # Stage methods, their extra arguments and number of workers.
+            # Failed files skip the next stages, except the cleanup.
+            stages = [(self.fetch_file_stage, (), download_workers),
+                      (self.anonymise_file_stage, (cpu_pool,), cpu_workers),
+                      (self.publish_file_stage, (conn,), upload_workers),
+                      (self.cleanup_file_stage, (), download_workers)]
+            return asyncio.run(run())
+
+    def add_stage_tracer(self, tracer):
+        """Register a tracer called with the name of each stage, and returning
+        a context manager wrapping it, e.g. the start_as_current_span method
+        of an OpenTelemetry tracer"""
+
+        self.__dict__.setdefault("_stage_tracers", []).append(tracer)
+
+    def create_pipeline_metrics(self, filename):
+        return PipelineMetrics(filename,
+                               tracers=self.__dict__.get("_stage_tracers", []))
+
+    def write_prometheus_metrics(self, metrics_list):
+        """Write the stage metrics in the Prometheus text format to
+        METRICS_PROMETHEUS_FILE, e.g. for the textfile collector of the node
+        exporter. Nothing is written when it is not configured."""
+
+        import os
+
+        path = self.get_config_value("METRICS_PROMETHEUS_FILE")
+        if path is None:
+            return
+
+        content = PipelineMetrics.to_prometheus(metrics_list)
+        # Replace the file atomically so scrapes never see a partial file
+        with open(f"{path}.tmp", "w") as metrics_file:
+            metrics_file.write(content)
+        os.replace(f"{path}.tmp", path)
+
+    def list_batch_files(self, data_info):
+        """List the files of a batch, either given as a list of file names or
+        of data_info dictionaries in data_info['files'], or as an object
+        storage prefix under edf_data_tmp/ in data_info['prefix']. Fields
+        which are not set per file are taken from data_info."""
+
+        shared_info = {key: value for key, value in data_info.items()
+                       if key not in ("files", "prefix")}
+
+        files = data_info.get("files")
+        if files is None and data_info.get("prefix") is not None:
+            prefix = data_info["prefix"]
+            if not prefix.startswith("edf_data_tmp/"):
+                raise ValueError("Batch prefix must be under edf_data_tmp/.")
+
+            files = self.list_tmp_edf_files(prefix)
+
+        if files is None:
+            raise ValueError("Batch requires either files or prefix.")
+
+        batch = []
+        for file_info in files:
+            if isinstance(file_info, str):
+                file_info = {"filename": file_info}
+            batch.append({**shared_info, **file_info})
+        return batch
+
+    def list_tmp_edf_files(self, prefix):
+        """List the keys of the edf files stored under the prefix in the local
+        object storage"""
+
+        s3_local = self.get_s3_client(local=True)
+        return [key for key in
+                self.list_object_keys(s3_local,
+                                      self.__OBJ_STORAGE_BUCKET_LOCAL__,
+                                      prefix)
+                if not key.endswith("/")]
+
+    def batch_action(self, input_meta: PluginExchangeMetadata = None) -> \
+          PluginActionResponse:
+        """
+        Run the anonymisation process for a batch of edf files. Files go
+        through the stages of run_pipeline, so downloads, anonymisations and
+        uploads of different files overlap. A report with the outcome of each
+        file is returned in the data_info of the response.
+        """
+
+        batch = self.list_batch_files(input_meta.data_info)
+
+        # Without the metadata sink, files share one connection
+        sink = self.get_metadata_sink()
+        conn = self.get_trino_connection() if sink is None else None
+
+        jobs = self.run_pipeline(batch, conn)
+
+        metadata_flush = None
+        if sink is not None:
+            # Rows of the batch are visible once it is finished, rows of a
+            # failed flush stay spooled for the next one
+            try:
+                metadata_flush = {"status": "success",
+                                  "inserted_rows": sink.flush()}
+            except Exception as e:
+                print(f"Flush of the metadata rows failed with error: {e}")
+                metadata_flush = {"status": "failed", "error": str(e),
+                                  "spooled_rows": sink.buffered_rows}
+
+        reports = []
+        for job in jobs:
+            report = {"filename": job["data_info"]["filename"],
+                      "status": "success" if job["error"] is None
+                      else "failed"}
+            if job["error"] is not None:
+                report["error"] = job["error"]
+                report["traceback"] = job["traceback"]
+            report["elapsed_seconds"] = job["elapsed_seconds"]
+            if job.get("admission") is not None:
+                report["admission"] = {
+                    key: value for key, value in job["admission"].items()
+                    if key not in ("controller", "reservation_id")}
+            report["metrics"] = job["metrics"].report()
+            reports.append(report)
+
+        self.write_prometheus_metrics([job["metrics"] for job in jobs])
+
+        failed = [report for report in reports
+                  if report["status"] != "success"]
+        for report in failed:
+            print(f"EDF processing of {report['filename']} failed with error: "
+                  f"{report['error']}")
+        print(f"Processed {len(reports)} files, {len(failed)} failed.")
+
+        data_info = {"files": reports,
+                     "succeeded": len(reports) - len(failed),
+                     "failed": len(failed)}
+        if metadata_flush is not None:
+            # Rows of the files are not in Trino yet when the flush failed
+            data_info["metadata_flush"] = metadata_flush
+        if self.get_config_value("ADMISSION_CONTROL", True, bool):
+            data_info["admission"] = self.get_admission_controller().report()
+
+        return PluginActionResponse(data_info=data_info)
+
+    def action(self, input_meta: PluginExchangeMetadata = None) -> \
+          PluginActionResponse:
+        """
+        Run the anonymisation process of the edf files.
+        Extract metadata from the edf files.
+        Upload anonymized files to the corresponding storage.
+        Batches, given with data_info['files'] or data_info['prefix'], are
+        run by batch_action.
+        """
+
+        import traceback
+
+        if "files" in input_meta.data_info or \
+                "prefix" in input_meta.data_info:
+            return self.batch_action(input_meta)
+
+        metrics = self.create_pipeline_metrics(
+            input_meta.data_info['filename'])
+        data_info = {"status": "success"}
+        try:
+            self.process_file(input_meta.data_info, metrics=metrics)
+        except Exception as e:
+            print("EDF processing failed with error: " + str(e))
+            data_info = {"status": "failed", "error": str(e),
+                         "traceback": traceback.format_exc()}
 
-            self.remove_tmp_edf_files(input_meta.data_info['filename'])
+        self.write_prometheus_metrics([metrics])
 
-        return PluginActionResponse()
+        data_info["metrics"] = metrics.report()
+        return PluginActionResponse(data_info=data_info)
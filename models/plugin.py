@@ -9,13 +9,23 @@ import sys
 import subprocess
 import virtualenv
 import configparser
+import contextlib
 import datetime
+import hashlib
+import importlib
+import time
 
 
 PLUGIN_CONF_FILE_NAME = 'mescobrad_edge/plugins/edf_anonymisation_plugin/plugin.config'
 PLUGIN_CONF_MAIN_SECTION = 'plugin-configuration'
 PLUGIN_OUTPUT_FILE_DEST = '.'
 PLUGIN_OUTPUT_FILE_NAME_FORMAT = '{plugin_name}-{timestamp}'
+PLUGIN_REQUIREMENTS_FILE_NAME = 'requirements.txt'
+PLUGIN_VENV_READY_FILE_NAME = '.ready'
+PLUGIN_PRELOAD_MODULES = 'numpy,pandas,pyedflib,boto3,botocore,trino'
+
+# Virtual environments already activated in this process
+_ACTIVATED_VENVS = set()
 
 @dataclass
 class PluginActionResponse():
@@ -43,32 +53,98 @@ class EmptyPlugin():
         for k in config[PLUGIN_CONF_MAIN_SECTION]:
             self.__dict__[(f"__{k}__").upper()] = config[PLUGIN_CONF_MAIN_SECTION][k]
 
-        # create a venv with the requirements specification
-        self.__venv_path__ = os.path.join(os.path.abspath(os.path.dirname(os.path.realpath(__file__))), ".venv")
+        started = time.perf_counter()
+        self.__startup_report__ = {}
+
+        # create a venv with the requirements specification, venvs are cached
+        # by the hash of the requirements so they are only built once
+        self.__plugin_path__ = os.path.dirname(os.path.abspath(os.path.dirname(os.path.realpath(__file__))))
+        self.__requirements_path__ = os.path.join(self.__plugin_path__, PLUGIN_REQUIREMENTS_FILE_NAME)
+        self.__venv_path__ = os.path.join(self.__plugin_path__, f".venv-{self.__requirements_hash__()}")
         print(self.__venv_path__)
         self.__setup_venv__()
 
+        # In warm worker mode the heavy modules are imported once, when the
+        # plugin is created, and stay imported across invocations
+        if self.__dict__.get("__PLUGIN_WARM_WORKER__", "").strip().lower() in ("1", "true", "yes", "on"):
+            self.__activate_venv__()
+            self.__preload_modules__()
+
+        self.__startup_report__["total_seconds"] = time.perf_counter() - started
+        print(f"Plugin started in {self.__startup_report__['total_seconds']:.2f} s: {self.__startup_report__}")
+
 
     def __destroy__(self):
         # Check if venv folder exists
         if os.path.isdir(self.__venv_path__):
-            # Remove venv
-            shutil.rmtree(self.__venv_path__, ignore_errors=True)
+            # Remove venv, never while another process is building it
+            with self.__venv_lock__():
+                shutil.rmtree(self.__venv_path__, ignore_errors=True)
+            _ACTIVATED_VENVS.discard(self.__venv_path__)
+
+    def __requirements_hash__(self):
+        # Hash of the requirements specification and of the interpreter
+        # version, as the venv is bound to it
+        digest = hashlib.sha256(f"{sys.version_info.major}.{sys.version_info.minor}".encode())
+        if os.path.isfile(self.__requirements_path__):
+            with open(self.__requirements_path__, 'rb') as requirements_file:
+                digest.update(requirements_file.read())
+        return digest.hexdigest()[:16]
+
+    @contextlib.contextmanager
+    def __venv_lock__(self):
+        # Exclusive lock of the venv, shared by the processes of the node
+        try:
+            import fcntl
+        except ImportError:
+            # Builds are not serialised across processes
+            fcntl = None
+        with open(f"{self.__venv_path__}.lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
 
     def __setup_venv__(self):
-        # Check if venv folder exists
-        if not os.path.isdir(self.__venv_path__):
-            # Create new venv
-            virtualenv.cli_run([self.__venv_path__])
-            # Activate venv
-            self.__activate_venv__()
-            # install pre_requisite on the venv
-            subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"])
+        started = time.perf_counter()
+        ready_file = os.path.join(self.__venv_path__, PLUGIN_VENV_READY_FILE_NAME)
+        self.__startup_report__["venv_created"] = False
+        # Check if venv folder exists and its requirements were installed,
+        # otherwise (re)build it. The check is repeated with the lock held,
+        # as another process may have built it while this one was waiting.
+        if not os.path.isfile(ready_file):
+            with self.__venv_lock__():
+                if not os.path.isfile(ready_file):
+                    shutil.rmtree(self.__venv_path__, ignore_errors=True)
+                    # Create new venv
+                    virtualenv.cli_run([self.__venv_path__])
+                    # install pre_requisite on the venv, with the venv interpreter
+                    subprocess.check_call([os.path.join(self.__venv_path__, "bin", "python"), "-m", "pip", "install", "-r", self.__requirements_path__])
+                    open(ready_file, 'w').close()
+                    self.__startup_report__["venv_created"] = True
+        self.__startup_report__["venv_seconds"] = time.perf_counter() - started
 
     def __activate_venv__(self):
-        # Activate the venv on the current process
+        # Activate the venv on the current process, only once per process
+        if self.__venv_path__ in _ACTIVATED_VENVS:
+            return
+        started = time.perf_counter()
         activate_this_file = f"{self.__venv_path__}/bin/activate_this.py"
-        exec(open(activate_this_file).read())
+        exec(open(activate_this_file).read(), {'__file__': activate_this_file})
+        _ACTIVATED_VENVS.add(self.__venv_path__)
+        self.__startup_report__["activation_seconds"] = time.perf_counter() - started
+
+    def __preload_modules__(self):
+        # Import the heavy modules used by the plugin actions
+        started = time.perf_counter()
+        modules = self.__dict__.get("__PLUGIN_PRELOAD_MODULES__", "").strip() or PLUGIN_PRELOAD_MODULES
+        for module in modules.split(","):
+            if module.strip():
+                importlib.import_module(module.strip())
+        self.__startup_report__["preload_seconds"] = time.perf_counter() - started
 
     def __load__(self, input_file: PluginExchangeMetadata) -> Any:
         # Load input data
@@ -109,7 +185,7 @@ class EmptyPlugin():
             # Store the action output
             outputFileMetadata = self.__store__(output)
         else:
-            # Create an empty exchange metadata
-            outputFileMetadata = PluginExchangeMetadata()
+            # Create an exchange metadata without file, keeping the data info
+            outputFileMetadata = PluginExchangeMetadata(data_info=output.data_info)
 
         return outputFileMetadata